@@ -2,104 +2,43 @@
 import os
 import sqlite3
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, g, send_from_directory, session, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Request, Response, render_template, stream_template, request, redirect, url_for, flash, get_flashed_messages, g, send_from_directory, session, jsonify
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 import subprocess
 import requests
 import uuid
 import shutil
 import base64
+import tempfile
+import json
+import re
+import time
+import queue
+import threading
+import fcntl
+import hashlib
+import struct
+import gzip
+import zlib
+import mimetypes
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from markupsafe import Markup
+try:
+    import brotli  # optional: adds Content-Encoding: br
+except ImportError:
+    brotli = None
 from flask import Flask, render_template, request, jsonify
 import os
 import subprocess
 from datetime import datetime
 # ...whatever imports you already have...
 
-# --- small-image fixer for ffmpeg (paste after imports) ---
-from PIL import Image
-
-def ensure_min_image_size(path, min_w=720, min_h=1280, bg_color=(255,255,255)):
-    """
-    If the image at `path` is smaller than min_w/min_h, create a new image
-    min_w x min_h with bg_color and center the original image on it.
-    Overwrites the original file with an RGB PNG.
-    """
-    try:
-        with Image.open(path) as im:
-            w, h = im.size
-            if w >= min_w and h >= min_h:
-                return path
-
-            if im.mode != "RGBA":
-                im = im.convert("RGBA")
-
-            bg = Image.new("RGBA", (min_w, min_h), bg_color + (255,))
-            x = (min_w - w) // 2
-            y = (min_h - h) // 2
-            bg.paste(im, (x, y), im)
-
-            bg_rgb = bg.convert("RGB")
-            bg_rgb.save(path, format="PNG")
-
-    except Exception as e:
-        print("ensure_min_image_size failed:", e)
-
-    return path
-# --- end helper ---
-
-# --- paste this near the top of app.py (with other imports) ---
+# --- image normalization for ffmpeg inputs (see image_prep.py) ---
 from io import BytesIO
-from PIL import Image, ImageOps
-
-def save_image_safely(file_storage, out_path, target_size=(720, 1280), fill_color=(255, 255, 255)):
-    """
-    Save an uploaded image (werkzeug FileStorage or file-like) to out_path.
-    - If the image is tiny or invalid, create a target_size canvas and center the image on it.
-    - Always write a PNG/RGB file that ffmpeg can consume.
-    """
-    # read bytes (works for FileStorage and file-like objects)
-    try:
-        data = file_storage.read()
-    except Exception:
-        # fallback: attempt direct save if read() fails
-        try:
-            with open(out_path, "wb") as f:
-                file_storage.save(f)
-        except Exception:
-            raise
-        return
-
-    # Try open with Pillow
-    try:
-        img = Image.open(BytesIO(data))
-        img = img.convert("RGBA")
-    except Exception:
-        # if Pillow can't open, write raw bytes to disk
-        with open(out_path, "wb") as f:
-            f.write(data)
-        return
-
-    w, h = img.size
-
-    # If image is very small (1x1 or tiny), place it on a target canvas
-    if w < 50 or h < 50 or (w == 1 and h == 1):
-        canvas = Image.new("RGBA", (target_size[0], target_size[1]), fill_color + (255,))
-        thumb = ImageOps.contain(img, target_size)  # keep aspect ratio
-        paste_x = (target_size[0] - thumb.width) // 2
-        paste_y = (target_size[1] - thumb.height) // 2
-        canvas.paste(thumb, (paste_x, paste_y), thumb)
-        canvas.convert("RGB").save(out_path, format="PNG")
-    else:
-        # For normal images, just ensure RGB PNG (so ffmpeg won't choke)
-        img.convert("RGB").save(out_path, format="PNG")
-
-    # try to reset file_storage pointer for callers that expect it (best effort)
-    try:
-        file_storage.seek(0)
-    except Exception:
-        pass
-# --- end helper ---
+from PIL import Image
+from image_prep import EXIF_ORIENTATION, ROTATED_ORIENTATIONS, save_image_safely
 
 # ---------- Configuration ----------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -117,7 +56,20 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 # ensure audio library folder exists (optional)
 os.makedirs(os.path.join(BASE_DIR, "static", "audio_library"), exist_ok=True)
 
+# ---------- Request class: spool multipart uploads to disk ----------
+# Werkzeug keeps each file part in memory up to 500KB before spilling to a
+# temp file. A 20-photo slideshow would then hold ~10MB per request, so we
+# spill much earlier and let handlers stream from the temp file.
+UPLOAD_SPOOL_BYTES = 64 * 1024
+
+
+class StreamingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode="rb+")
+
+
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.secret_key = "change_this_for_production"  # change for real deployment
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # 20 MB
@@ -125,12 +77,237 @@ app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # 20 MB
 # Keep session alive
 app.permanent_session_lifetime = timedelta(days=30)
 
+# ---------- Response compression ----------
+# Dynamic HTML/JSON/CSS/JS above COMPRESS_MIN_BYTES is compressed on the way
+# out (brotli when the module is installed and accepted, else gzip). Static
+# text assets are compressed once by precompress_static.py (run from the
+# Procfile before gunicorn starts) and the .br/.gz sibling is sent as-is.
+# Streamed pages (the home feed) are compressed as they are generated, with a
+# sync flush once COMPRESS_STREAM_FLUSH_BYTES of input has built up: a flush
+# per Jinja fragment would add its framing to every few hundred bytes, while
+# a few KB is still only a card or two of delay.
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml",
+}
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5  # dynamic pages; the static script uses 11
+COMPRESS_STREAM_FLUSH_BYTES = 4 * 1024
+STATIC_PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))  # preference order
+
+def accepted_encodings():
+    """Content codings the client accepts (q > 0), lower-cased."""
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name)
+    return accepted
+
+def _compress_stream(chunks, coding):
+    if coding == "br":
+        packer = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        feed, flush, end = packer.process, packer.flush, packer.finish
+    else:
+        packer = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip framing
+        feed, flush, end = packer.compress, (lambda: packer.flush(zlib.Z_SYNC_FLUSH)), packer.flush
+    pending = 0  # input bytes fed since the last flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if not chunk:
+                continue
+            out = feed(chunk)
+            pending += len(chunk)
+            if pending >= COMPRESS_STREAM_FLUSH_BYTES:
+                out += flush()
+                pending = 0
+            if out:
+                yield out
+        yield end()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        accepted = accepted_encodings()
+        coding = "br" if brotli is not None and "br" in accepted else "gzip" if "gzip" in accepted else None
+        if coding:
+            response.response = _compress_stream(response.response, coding)
+            response.headers["Content-Encoding"] = coding
+            response.headers.pop("Content-Length", None)
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    accepted = accepted_encodings()
+    if brotli is not None and "br" in accepted:
+        response.set_data(brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY))
+        response.headers["Content-Encoding"] = "br"
+    elif "gzip" in accepted:
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+def send_static_precompressed(filename):
+    """The static endpoint, preferring an up-to-date .br/.gz sibling."""
+    src = safe_join(app.static_folder, filename)
+    if src and os.path.isfile(src):
+        accepted = accepted_encodings()
+        for coding, suffix in STATIC_PRECOMPRESSED:
+            if coding not in accepted:
+                continue
+            packed = src + suffix
+            try:
+                if os.path.getmtime(packed) < os.path.getmtime(src):
+                    continue
+            except OSError:
+                continue
+            response = send_from_directory(app.static_folder, filename + suffix,
+                                           mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                                           max_age=app.get_send_file_max_age(filename))
+            response.headers["Content-Encoding"] = coding
+            response.vary.add("Accept-Encoding")
+            return apply_asset_caching(response, filename)
+    return apply_asset_caching(app.send_static_file(filename), filename)
+
+app.view_functions["static"] = send_static_precompressed
+
+# ---------- Render scratch space ----------
+# Each slideshow render gets a private directory under RENDER_SCRATCH_ROOT.
+# Point KIDSTA_RENDER_SCRATCH at a tmpfs (e.g. /dev/shm) to keep the
+# intermediate ffmpeg I/O off the persistent disk.
+def _default_scratch_root():
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return os.path.join(shm, "kidsta_renders")
+    return os.path.join(tempfile.gettempdir(), "kidsta_renders")
+
+RENDER_SCRATCH_ROOT = os.environ.get("KIDSTA_RENDER_SCRATCH") or _default_scratch_root()
+RENDER_DIR_PREFIX = "render_"
+RENDER_STALE_SECONDS = 60 * 60  # older than any real render
+RENDER_PROGRESS_PREFIX = "progress_"
+
+# temp names written straight into static/uploads: the old shared-folder
+# renders and upload_reel's in-flight files
+LEGACY_RENDER_TEMP_PREFIXES = ("concat_", "tmp_img_", "tmp_upimg_", "tmp_upvid_", "photo_", "merged_", "tmp_reel_")
+
+os.makedirs(RENDER_SCRATCH_ROOT, exist_ok=True)
+
+# ---------- Static asset fingerprints ----------
+# url_for("static", ...) and url_for("uploaded_audio", ...) get ?v=<content
+# hash> appended. A request whose v matches the file's current hash is served
+# as immutable for a year, so repeat visits don't even revalidate; anything
+# else (no v, stale v) gets the normal ETag revalidation. Hashes are kept by
+# (size, mtime), warmed at startup and persisted in the scratch dir so worker
+# boots don't re-read the audio library.
+ASSET_MANIFEST_PATH = os.path.join(RENDER_SCRATCH_ROOT, "static_manifest.json")
+ASSET_SKIP_DIRS = ("uploads",)
+ASSET_SKIP_SUFFIXES = (".gz", ".br", ".tmp")
+ASSET_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_asset_manifest = {}  # relpath under static/ -> (size, mtime_ns, hash)
+_asset_lock = threading.Lock()
+
+def _hash_file(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+def asset_version(relpath):
+    """Content hash for static/<relpath>, or None if it isn't a servable file."""
+    relpath = relpath.replace(os.sep, "/")
+    if relpath.split("/", 1)[0] in ASSET_SKIP_DIRS:
+        return None
+    path = safe_join(app.static_folder, relpath)
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        return None
+    if st is None:
+        return None
+    entry = _asset_manifest.get(relpath)
+    if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+    digest = _hash_file(path)
+    with _asset_lock:
+        _asset_manifest[relpath] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+def build_asset_manifest():
+    """Hash every static asset (reusing the saved manifest for unchanged files)."""
+    try:
+        with open(ASSET_MANIFEST_PATH) as f:
+            _asset_manifest.update({k: tuple(v) for k, v in json.load(f).items()})
+    except (OSError, ValueError):
+        pass
+    for dirpath, dirnames, filenames in os.walk(app.static_folder):
+        if dirpath == app.static_folder:
+            dirnames[:] = [d for d in dirnames if d not in ASSET_SKIP_DIRS]
+        for name in filenames:
+            if not name.endswith(ASSET_SKIP_SUFFIXES):
+                asset_version(os.path.relpath(os.path.join(dirpath, name), app.static_folder))
+    try:
+        tmp = f"{ASSET_MANIFEST_PATH}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(_asset_manifest, f)
+        os.replace(tmp, ASSET_MANIFEST_PATH)
+    except OSError as e:
+        print("asset manifest not saved:", e)
+
+@app.url_defaults
+def add_asset_fingerprint(endpoint, values):
+    if "v" in values or "filename" not in values:
+        return
+    if endpoint == "static":
+        v = asset_version(values["filename"])
+    elif endpoint == "uploaded_audio":
+        v = asset_version("audio_library/" + values["filename"])
+    else:
+        return
+    if v:
+        values["v"] = v
+
+def apply_asset_caching(response, relpath):
+    v = request.args.get("v")
+    if v and response.status_code in (200, 304) and v == asset_version(relpath):
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+build_asset_manifest()
+
 # ---------- ACRCloud config (fill these if needed) ----------
 ACR_HOST = "https://identify-eu-west-1.acrcloud.com/v1/identify"  # example endpoint
 ACCESS_KEY = "YOUR_ACR_KEY"
 ACCESS_SECRET = "YOUR_ACR_SECRET"
 
 # ---------- DB helper ----------
+SCHEMA_VERSION = 7  # PRAGMA user_version; bump when init_db() grows a data migration
+
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
@@ -138,8 +315,66 @@ def get_db():
         db.row_factory = sqlite3.Row
     return db
 
+def ensure_column(cur, table, column, decl):
+    """Add `column` to an existing table if an older DB doesn't have it yet."""
+    cols = [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in cols:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def migrate_legacy_friends(cur):
+    """
+    Fold the old directional `friends` rows into friendships/friend_requests.
+    Accepted rows in either direction collapse to one (lo, hi) pair; for
+    requests the newest row per direction wins, and requests between users
+    who are already friends are dropped. The `friends` table is left as-is.
+    """
+    cur.execute("""
+        INSERT OR IGNORE INTO friendships (user_lo, user_hi, created_at)
+        SELECT MIN(user_id, friend_id), MAX(user_id, friend_id), MIN(created_at)
+        FROM friends
+        WHERE status = 'accepted' AND user_id != friend_id
+        GROUP BY MIN(user_id, friend_id), MAX(user_id, friend_id)
+    """)
+    cur.execute("""
+        INSERT OR IGNORE INTO friend_requests (from_id, to_id, status, created_at)
+        SELECT f.user_id, f.friend_id, f.status, f.created_at
+        FROM friends f
+        WHERE f.status != 'accepted' AND f.user_id != f.friend_id
+          AND f.id = (SELECT MAX(id) FROM friends f2
+                      WHERE f2.user_id = f.user_id AND f2.friend_id = f.friend_id
+                        AND f2.status != 'accepted')
+          AND NOT EXISTS (SELECT 1 FROM friendships s
+                          WHERE s.user_lo = MIN(f.user_id, f.friend_id)
+                            AND s.user_hi = MAX(f.user_id, f.friend_id))
+    """)
+
+def backfill_notification_counters(cur):
+    """Seed notification_counters from rows written before the triggers existed."""
+    cur.execute("DELETE FROM notification_counters")
+    cur.execute("""
+        INSERT INTO notification_counters (user_id, unread)
+        SELECT user_id, COUNT(*) FROM notifications
+        WHERE COALESCE(is_read, 0) = 0
+        GROUP BY user_id
+    """)
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
 def init_db():
-    db = get_db()
+    """
+    Create/migrate the schema once per process. Routes still call this
+    first thing; after the first call it is a flag check.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            _init_schema(get_db())
+            _schema_ready = True
+
+def _init_schema(db):
     cur = db.cursor()
 
     # users (added bio column so edit_profile can save bio)
@@ -192,6 +427,22 @@ def init_db():
     )
     """)
 
+    # post_media metadata, filled at upload (older rows by the media-meta
+    # backfill): intrinsic size, a placeholder colour and a video poster frame
+    ensure_column(cur, "post_media", "width", "INTEGER")
+    ensure_column(cur, "post_media", "height", "INTEGER")
+    ensure_column(cur, "post_media", "placeholder", "TEXT")
+    ensure_column(cur, "post_media", "poster", "TEXT")
+    ensure_column(cur, "post_media", "meta_at", "TEXT")
+    # duration / size / bytes ahead of the first mdat box (progressive MP4s)
+    # for the reels feed's prefetch hints
+    ensure_column(cur, "post_media", "duration", "REAL")
+    ensure_column(cur, "post_media", "bytes", "INTEGER")
+    ensure_column(cur, "post_media", "header_bytes", "INTEGER")
+    # last failed metadata attempt (missing file, no ffmpeg...); retried later
+    ensure_column(cur, "post_media", "meta_failed_at", "TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_post_media_post ON post_media (post_id, ord)")
+
     # notifications
     cur.execute("""
     CREATE TABLE IF NOT EXISTS notifications (
@@ -248,11 +499,230 @@ def init_db():
     )
     """)
 
+    # posts.deleted_at: tombstone set by delete_post(), cleared up by the collector
+    ensure_column(cur, "posts", "deleted_at", "TEXT")
+
+    # posts.comment_count / comment_version: kept by triggers on comments;
+    # the version keys the rendered-thread cache
+    ensure_column(cur, "posts", "comment_count", "INTEGER NOT NULL DEFAULT 0")
+    ensure_column(cur, "posts", "comment_version", "INTEGER NOT NULL DEFAULT 0")
+
+    # posts.version: bumped by anything that changes a rendered card
+    # (votes, comments, edits); keys the post-card fragment cache
+    ensure_column(cur, "posts", "version", "INTEGER NOT NULL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_comments_post ON comments (post_id, id)")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_comments_count_ins
+    AFTER INSERT ON comments
+    BEGIN
+        UPDATE posts SET comment_count = comment_count + 1, comment_version = comment_version + 1
+        WHERE id = NEW.post_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_comments_count_del
+    AFTER DELETE ON comments
+    BEGIN
+        UPDATE posts SET comment_count = MAX(comment_count - 1, 0), comment_version = comment_version + 1
+        WHERE id = OLD.post_id;
+    END
+    """)
+
+    # friendships: one row per pair, stored as (smaller id, larger id)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS friendships (
+        user_lo INTEGER NOT NULL,
+        user_hi INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (user_lo, user_hi),
+        CHECK (user_lo < user_hi)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_friendships_hi ON friendships (user_hi, user_lo)")
+
+    # friend_requests: at most one request per direction
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS friend_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_id INTEGER NOT NULL,
+        to_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at TEXT NOT NULL,
+        UNIQUE (from_id, to_id)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_friend_requests_to ON friend_requests (to_id, status)")
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_blocks_blocker ON blocks (blocker_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_blocks_blocked ON blocks (blocked_id)")
+
+    # friend_suggestions: precomputed friends-of-friends, ranked by mutual count
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS friend_suggestions (
+        user_id INTEGER NOT NULL,
+        suggested_id INTEGER NOT NULL,
+        mutual_count INTEGER NOT NULL,
+        computed_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, suggested_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_friend_suggestions_rank ON friend_suggestions (user_id, mutual_count DESC)")
+
+    # suggestion_dirty: users whose suggestions need recomputing
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS suggestion_dirty (
+        user_id INTEGER PRIMARY KEY,
+        marked_at TEXT NOT NULL
+    )
+    """)
+
+    # rollups: one unread row per (recipient, type, post, window) absorbs
+    # repeat likes/comments; actor_count and recent_actors describe who
+    ensure_column(cur, "notifications", "actor_count", "INTEGER NOT NULL DEFAULT 1")
+    ensure_column(cur, "notifications", "recent_actors", "TEXT")
+    ensure_column(cur, "notifications", "rollup_bucket", "INTEGER")
+    ensure_column(cur, "notifications", "updated_at", "TEXT")
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_rollup
+        ON notifications (user_id, type, post_id, rollup_bucket) WHERE is_read = 0
+    """)
+
+    # notification_actors: who is behind each rollup, so actor_count counts
+    # distinct people (recent_actors only keeps the last few)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS notification_actors (
+        notification_id INTEGER NOT NULL,
+        actor_id INTEGER NOT NULL,
+        PRIMARY KEY (notification_id, actor_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_notifications_actors_del
+    AFTER DELETE ON notifications
+    BEGIN
+        DELETE FROM notification_actors WHERE notification_id = OLD.id;
+    END
+    """)
+
+    # newest-activity-first keyset pagination of a user's notifications
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_notifications_feed ON notifications (user_id, updated_at DESC, id DESC)")
+
+    # notification_counters: unread count per user, kept in step by triggers
+    # so every writer (routes, the collector's cascade) updates it
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS notification_counters (
+        user_id INTEGER PRIMARY KEY,
+        unread INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_ins
+    AFTER INSERT ON notifications WHEN COALESCE(NEW.is_read, 0) = 0
+    BEGIN
+        INSERT OR IGNORE INTO notification_counters (user_id, unread) VALUES (NEW.user_id, 0);
+        UPDATE notification_counters SET unread = unread + 1 WHERE user_id = NEW.user_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_del
+    AFTER DELETE ON notifications WHEN COALESCE(OLD.is_read, 0) = 0
+    BEGIN
+        UPDATE notification_counters SET unread = MAX(unread - 1, 0) WHERE user_id = OLD.user_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_notifications_unread_upd
+    AFTER UPDATE OF is_read ON notifications
+    WHEN COALESCE(OLD.is_read, 0) != COALESCE(NEW.is_read, 0)
+    BEGIN
+        UPDATE notification_counters
+        SET unread = MAX(unread + CASE WHEN COALESCE(NEW.is_read, 0) = 0 THEN 1 ELSE -1 END, 0)
+        WHERE user_id = NEW.user_id;
+    END
+    """)
+
+    # feed_versions: change counters behind the page ETags. scope 0 is the
+    # whole home feed, any other scope is a user id (their posts, their
+    # blocks, their pending requests). Bumped by triggers so every writer,
+    # including the collector, counts.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS feed_versions (
+        scope INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    feed_bumps = {
+        "trg_feed_posts_ins": ("AFTER INSERT ON posts", "(0, 1), (NEW.user_id, 1)"),
+        "trg_feed_posts_upd": ("AFTER UPDATE ON posts", "(0, 1), (NEW.user_id, 1)"),
+        "trg_feed_posts_del": ("AFTER DELETE ON posts", "(0, 1), (OLD.user_id, 1)"),
+        "trg_feed_users_upd": ("AFTER UPDATE OF display_name, kidsta_id, avatar_filename ON users",
+                               "(0, 1), (NEW.id, 1)"),
+        "trg_feed_blocks_ins": ("AFTER INSERT ON blocks", "(NEW.blocker_id, 1), (NEW.blocked_id, 1)"),
+        "trg_feed_blocks_del": ("AFTER DELETE ON blocks", "(OLD.blocker_id, 1), (OLD.blocked_id, 1)"),
+        "trg_feed_requests_ins": ("AFTER INSERT ON friend_requests", "(NEW.to_id, 1)"),
+        "trg_feed_requests_upd": ("AFTER UPDATE ON friend_requests", "(NEW.to_id, 1)"),
+        "trg_feed_requests_del": ("AFTER DELETE ON friend_requests", "(OLD.to_id, 1)"),
+    }
+    for name, (event, scopes) in feed_bumps.items():
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {name}
+        {event}
+        BEGIN
+            INSERT INTO feed_versions (scope, version) VALUES {scopes}
+            ON CONFLICT (scope) DO UPDATE SET version = version + 1;
+        END
+        """)
+
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        migrate_legacy_friends(cur)
+    if version < 2:
+        backfill_notification_counters(cur)
+    if version < 3:
+        cur.execute("DROP INDEX IF EXISTS idx_notifications_user")
+        cur.execute("UPDATE notifications SET updated_at = created_at WHERE updated_at IS NULL")
+    if version < 4:
+        # one vote per (user, post): keep the newest row before the unique index
+        cur.execute("""
+            DELETE FROM likes WHERE id NOT IN (
+                SELECT MAX(id) FROM likes GROUP BY user_id, post_id
+            )
+        """)
+    if version < 5:
+        cur.execute("UPDATE posts SET comment_count = (SELECT COUNT(*) FROM comments c WHERE c.post_id = posts.id)")
+    if version < 6:
+        # reels/slideshows used to live only in posts.media_filename; give them
+        # post_media rows, and have the backfill redo videos for duration/size
+        cur.execute("""
+            INSERT INTO post_media (post_id, filename, media_type, ord, created_at)
+            SELECT id, media_filename, 'video', 1, created_at FROM posts
+            WHERE media_filename IS NOT NULL
+              AND (lower(media_filename) LIKE '%.mp4' OR lower(media_filename) LIKE '%.mov'
+                   OR lower(media_filename) LIKE '%.webm')
+              AND NOT EXISTS (SELECT 1 FROM post_media pm WHERE pm.post_id = posts.id)
+        """)
+        cur.execute("UPDATE post_media SET meta_at = NULL WHERE media_type = 'video'")
+    if version < 7:
+        # open rollups keep their actor_count; seed who we know is in them
+        cur.execute("""
+            INSERT OR IGNORE INTO notification_actors (notification_id, actor_id)
+            SELECT n.id, j.value FROM notifications n, json_each(n.recent_actors) j
+            WHERE n.is_read = 0 AND n.recent_actors IS NOT NULL
+        """)
+    if version < SCHEMA_VERSION:
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    # after the dedupe above: toggle_like() upserts against this
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_likes_user_post ON likes (user_id, post_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_likes_post_value ON likes (post_id, value)")
+
     db.commit()
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, "_database", None)
+    # pop, not just close: a streamed response (home feed) re-enters the
+    # context after this teardown and must get a fresh connection
+    db = g.pop("_database", None)
     if db is not None:
         db.close()
 
@@ -263,63 +733,956 @@ def allowed_file(filename):
     ext = filename.rsplit(".", 1)[-1].lower()
     return ext in ALLOWED_EXT
 
+# --- uploads storage layout ---
+# New files live in hashed shards (static/uploads/ab/cd/<name>) so no single
+# directory grows without bound. The DB stores the relative "ab/cd/<name>"
+# path; rows from before sharding still hold a bare flat name.
+def shard_upload_name(filename):
+    """'x.jpg' -> 'ab/cd/x.jpg' where ab/cd come from a hash of the name."""
+    base = os.path.basename(filename)
+    h = hashlib.md5(base.encode("utf-8")).hexdigest()
+    return f"{h[0:2]}/{h[2:4]}/{base}"
+
+def new_upload_path(filename):
+    """Storage name and absolute path (parent dirs created) for a new upload."""
+    name = shard_upload_name(filename)
+    path = os.path.join(app.config["UPLOAD_FOLDER"], name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return name, path
+
+def resolve_upload_name(name):
+    """
+    Map a stored name to where the file actually is: legacy flat names are
+    served from their shard once the migration has moved them.
+    """
+    if not name or "/" in name:
+        return name
+    if os.path.exists(os.path.join(app.config["UPLOAD_FOLDER"], name)):
+        return name
+    return shard_upload_name(name)
+
+# ---------- Current-user cache ----------
+# get_current_user() is called by almost every route. The row is memoised on
+# g for the request and in a small per-worker TTL cache across requests.
+# Routes that change a users row call invalidate_current_user(), which also
+# stamps the editor's session so their next request on *any* worker reloads.
+USER_CACHE_MAX = 10000
+USER_CACHE_TTL = 30  # seconds
+
+_user_cache = OrderedDict()  # user_id -> (loaded_at, session rev, CurrentUser)
+_user_cache_lock = threading.Lock()
+
+class CurrentUser(dict):
+    """Snapshot of a users row without the password hash; user["x"] or user.x."""
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
 def get_current_user():
     """
-    Returns sqlite3.Row for logged-in user or None
+    Returns a CurrentUser for the logged-in user or None
     """
     uid = session.get("user_id")
     if not uid:
         return None
-    db = get_db()
-    return db.execute("SELECT * FROM users WHERE id = ?", (uid,)).fetchone()
+    if "_current_user" in g:
+        return g._current_user
+
+    rev = session.get("user_rev")
+    now = time.time()
+    with _user_cache_lock:
+        hit = _user_cache.get(uid)
+        if hit and now - hit[0] < USER_CACHE_TTL and hit[1] == rev:
+            _user_cache.move_to_end(uid)
+            g._current_user = hit[2]
+            return hit[2]
+
+    row = get_db().execute("SELECT * FROM users WHERE id = ?", (uid,)).fetchone()
+    user = None
+    if row:
+        user = CurrentUser((k, row[k]) for k in row.keys() if k != "password")
+        with _user_cache_lock:
+            _user_cache[uid] = (now, rev, user)
+            _user_cache.move_to_end(uid)
+            while len(_user_cache) > USER_CACHE_MAX:
+                _user_cache.popitem(last=False)
+    g._current_user = user
+    return user
+
+def invalidate_current_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+    g.pop("_current_user", None)
+    if session.get("user_id") == user_id:
+        session["user_rev"] = int(time.time() * 1000)
+
+# ---------- Social graph cache ----------
+# Per-worker LRU of each user's accepted friends and block set (both
+# directions), loaded with a single query. Routes that change edges call
+# invalidate_social_graph(); the TTL bounds staleness in the *other* workers.
+SOCIAL_CACHE_MAX_USERS = 5000
+SOCIAL_CACHE_TTL = 60  # seconds
+
+_social_cache = OrderedDict()  # user_id -> (loaded_at, friend_ids, blocked_ids)
+_social_lock = threading.Lock()
+
+def _load_social_graph(user_id):
+    rows = get_db().execute("""
+        SELECT 'f' AS kind, user_hi AS other FROM friendships WHERE user_lo = ?
+        UNION ALL
+        SELECT 'f', user_lo FROM friendships WHERE user_hi = ?
+        UNION ALL
+        SELECT 'b', CASE WHEN blocker_id = ? THEN blocked_id ELSE blocker_id END
+        FROM blocks
+        WHERE blocker_id = ? OR blocked_id = ?
+    """, (user_id,) * 5).fetchall()
+    friends = frozenset(r["other"] for r in rows if r["kind"] == "f")
+    blocked = frozenset(r["other"] for r in rows if r["kind"] == "b")
+    return friends, blocked
+
+def get_social_graph(user_id):
+    """(friend_ids, blocked_ids) frozensets for user_id, cached per worker."""
+    now = time.time()
+    with _social_lock:
+        hit = _social_cache.get(user_id)
+        if hit and now - hit[0] < SOCIAL_CACHE_TTL:
+            _social_cache.move_to_end(user_id)
+            return hit[1], hit[2]
+
+    friends, blocked = _load_social_graph(user_id)
+    with _social_lock:
+        _social_cache[user_id] = (now, friends, blocked)
+        _social_cache.move_to_end(user_id)
+        while len(_social_cache) > SOCIAL_CACHE_MAX_USERS:
+            _social_cache.popitem(last=False)
+    return friends, blocked
+
+def invalidate_social_graph(*user_ids):
+    with _social_lock:
+        for uid in user_ids:
+            _social_cache.pop(uid, None)
 
 def is_blocked(viewer_id, target_id):
     """Check if two users are blocked from each other."""
     if not viewer_id or not target_id:
         return False
-
-    db = get_db()
-    row = db.execute("""
-        SELECT 1 FROM blocks
-        WHERE (blocker_id = ? AND blocked_id = ?)
-           OR (blocker_id = ? AND blocked_id = ?)
-        LIMIT 1
-    """, (viewer_id, target_id, target_id, viewer_id)).fetchone()
-
-    return row is not None
+    return target_id in get_social_graph(viewer_id)[1]
 
 def are_friends(user_id, other_id):
     """Check if two users are friends (accepted)."""
-    db = get_db()
-    row = db.execute("""
-        SELECT 1 FROM friends
-        WHERE user_id = ? AND friend_id = ? AND status = 'accepted'
-        LIMIT 1
-    """, (user_id, other_id)).fetchone()
-    if row:
-        return True
+    if not user_id or not other_id:
+        return False
+    return other_id in get_social_graph(user_id)[0]
 
-    row2 = db.execute("""
-        SELECT 1 FROM friends
-        WHERE user_id = ? AND friend_id = ? AND status = 'accepted'
-        LIMIT 1
-    """, (other_id, user_id)).fetchone()
-    return row2 is not None
+def can_view_post(viewer_id, author_id, visibility):
+    """Friends-only posts are for the author and their friends; nobody sees a blocked author's posts."""
+    if viewer_id == author_id:
+        return True
+    friends, blocked = get_social_graph(viewer_id)
+    if author_id in blocked:
+        return False
+    return visibility != "friends" or author_id in friends
+
+def friend_pair(a, b):
+    """Key of the friendships row for two users: (smaller id, larger id)."""
+    return (a, b) if a < b else (b, a)
+
+def friendship_exists(a, b):
+    """Uncached single primary-key probe."""
+    return get_db().execute(
+        "SELECT 1 FROM friendships WHERE user_lo = ? AND user_hi = ?", friend_pair(a, b)
+    ).fetchone() is not None
+
+def add_friendship(db, a, b):
+    """Upsert the (a, b) edge and close any requests between them. No commit."""
+    db.execute("INSERT INTO friendships (user_lo, user_hi, created_at) VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+               friend_pair(a, b) + (datetime.utcnow().isoformat(),))
+    db.execute("""
+        UPDATE friend_requests SET status = 'accepted'
+        WHERE ((from_id = ? AND to_id = ?) OR (from_id = ? AND to_id = ?)) AND status = 'pending'
+    """, (a, b, b, a))
+
+def filter_blocked(viewer_id, user_ids):
+    """Keep the ids (in order) that aren't blocked with viewer_id either way."""
+    if not viewer_id:
+        return list(user_ids)
+    blocked = get_social_graph(viewer_id)[1]
+    return [uid for uid in user_ids if uid not in blocked]
+
+def filter_friends(viewer_id, user_ids):
+    """Keep the ids (in order) that are accepted friends of viewer_id."""
+    if not viewer_id:
+        return []
+    friends = get_social_graph(viewer_id)[0]
+    return [uid for uid in user_ids if uid in friends]
+
+NOTIFICATION_ROLLUP_WINDOW = 24 * 60 * 60  # seconds; one unread rollup per post/type per window
+NOTIFICATION_RECENT_ACTORS = 3
 
 def create_notification(user_id, notif_type, from_user_id=None, post_id=None):
-    """Create a notification row."""
+    """
+    Create a notification row. Post-scoped notifications (likes, comments)
+    upsert into the recipient's unread rollup for that post and window
+    instead, updating recent_actors; actor_count only grows for an actor
+    the rollup hasn't seen (notification_actors).
+    """
     if not user_id:
         return
     db = get_db()
-    created_at = datetime.utcnow().isoformat()
+    now = datetime.utcnow().isoformat()
+    actors = json.dumps([from_user_id] if from_user_id else [])
+    bucket = int(time.time() // NOTIFICATION_ROLLUP_WINDOW) if post_id else None
     try:
-        db.execute(
-            "INSERT INTO notifications (user_id, type, from_user_id, post_id, created_at) VALUES (?, ?, ?, ?, ?)",
-            (user_id, notif_type, from_user_id, post_id, created_at)
-        )
+        # post_id NULL (friend requests) never conflicts, so those stay one row each.
+        # A row with an actor starts at actor_count 0: the actor is counted
+        # below, once per notification
+        notif_id = db.execute("""
+            INSERT INTO notifications (user_id, type, from_user_id, post_id, created_at,
+                                       actor_count, recent_actors, rollup_bucket, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, type, post_id, rollup_bucket) WHERE is_read = 0 DO UPDATE SET
+                recent_actors = (
+                    SELECT json_group_array(value) FROM (
+                        SELECT excluded.from_user_id AS value
+                        UNION ALL
+                        SELECT * FROM (SELECT value FROM json_each(notifications.recent_actors)
+                                       WHERE value != excluded.from_user_id ORDER BY key)
+                        LIMIT ?)),
+                from_user_id = excluded.from_user_id,
+                updated_at = excluded.updated_at
+            RETURNING id
+        """, (user_id, notif_type, from_user_id, post_id, now, 0 if from_user_id else 1,
+              actors, bucket, now, NOTIFICATION_RECENT_ACTORS)).fetchone()[0]
+        if from_user_id:
+            new_actor = db.execute(
+                "INSERT OR IGNORE INTO notification_actors (notification_id, actor_id) VALUES (?, ?)",
+                (notif_id, from_user_id)).rowcount
+            if new_actor:
+                db.execute("UPDATE notifications SET actor_count = actor_count + 1 WHERE id = ?", (notif_id,))
         db.commit()
-    except Exception:
+    except Exception as e:
+        db.rollback()
+        print("create_notification error:", e)
+        return
+    row = db.execute("SELECT unread FROM notification_counters WHERE user_id = ?", (user_id,)).fetchone()
+    publish_event(f"user:{user_id}", {
+        "type": "notification",
+        "kind": notif_type,
+        "from_user_id": from_user_id,
+        "post_id": post_id,
+        "unread": row["unread"] if row else 0,
+    })
+
+# ---------- Background garbage collection ----------
+# delete_post() only tombstones the post (posts.deleted_at). A daemon thread
+# cascades the rows and unlinks the files, and a periodic sweep reconciles
+# the sharded part of static/uploads against everything the DB still
+# references. The thread is started by start_background_workers().
+GC_SWEEP_INTERVAL = 10 * 60           # seconds between sweeps
+GC_ORPHAN_GRACE_SECONDS = 6 * 60 * 60  # never touch files younger than this
+GC_LOCK_PATH = os.path.join(RENDER_SCRATCH_ROOT, "gc.lock")
+
+_gc_queue = queue.Queue()
+_gc_thread = None
+_gc_thread_lock = threading.Lock()
+
+def _gc_connect():
+    # threads can't use get_db() (no app context), so they get their own handle
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _unlink_upload(filename):
+    """Remove a file from UPLOAD_FOLDER, returning the bytes freed."""
+    if not filename:
+        return 0
+    path = os.path.join(app.config["UPLOAD_FOLDER"], resolve_upload_name(filename))
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+def _file_still_referenced(conn, filename):
+    row = conn.execute("""
+        SELECT 1 FROM posts WHERE media_filename = ? AND deleted_at IS NULL
+        UNION ALL
+        SELECT 1 FROM post_media pm JOIN posts p ON p.id = pm.post_id
+            WHERE (pm.filename = ? OR pm.poster = ?) AND p.deleted_at IS NULL
+        UNION ALL
+        SELECT 1 FROM users WHERE avatar_filename = ?
+        LIMIT 1
+    """, (filename, filename, filename, filename)).fetchone()
+    return row is not None
+
+def purge_post(conn, post_id):
+    """
+    Cascade a tombstoned post: delete its media, likes, comments and
+    notifications rows, then unlink files no live row still points at.
+    Returns bytes reclaimed.
+    """
+    post = conn.execute("SELECT media_filename FROM posts WHERE id = ? AND deleted_at IS NOT NULL", (post_id,)).fetchone()
+    if not post:
+        return 0
+    files = {post["media_filename"]} if post["media_filename"] else set()
+    for r in conn.execute("SELECT filename, poster FROM post_media WHERE post_id = ?", (post_id,)):
+        files.update(f for f in (r["filename"], r["poster"]) if f)
+
+    conn.execute("DELETE FROM post_media WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM likes WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM notifications WHERE post_id = ?", (post_id,))
+    conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+    conn.commit()
+
+    freed = 0
+    for fname in files:
+        if not _file_still_referenced(conn, fname):
+            freed += _unlink_upload(fname)
+    return freed
+
+def sweep_orphaned_uploads(conn, grace=GC_ORPHAN_GRACE_SECONDS):
+    """
+    Purge any tombstones the queue missed (e.g. after a restart), then delete
+    sharded uploads (files the app stored via new_upload_path) that no post,
+    post_media or avatar references. Flat legacy files and anything else in
+    UPLOAD_FOLDER are left alone.
+    Returns {"posts": n, "files": n, "bytes": n}.
+    """
+    report = {"posts": 0, "files": 0, "bytes": 0}
+
+    for r in conn.execute("SELECT id FROM posts WHERE deleted_at IS NOT NULL").fetchall():
+        report["bytes"] += purge_post(conn, r["id"])
+        report["posts"] += 1
+
+    referenced = set()
+    for sql in ("SELECT media_filename AS f FROM posts",
+                "SELECT filename AS f FROM post_media",
+                "SELECT poster AS f FROM post_media",
+                "SELECT avatar_filename AS f FROM users"):
+        for r in conn.execute(sql):
+            if r["f"]:
+                # a legacy flat name also protects the shard it may have moved to
+                referenced.add(r["f"])
+                referenced.add(shard_upload_name(r["f"]))
+
+    cutoff = time.time() - grace
+    folder = app.config["UPLOAD_FOLDER"]
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            name = os.path.relpath(path, folder).replace(os.sep, "/")
+            if name in referenced or fname.startswith(".") or name != shard_upload_name(fname):
+                continue
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            report["files"] += 1
+            report["bytes"] += size
+
+    return report
+
+def _gc_sweep_locked():
+    # one sweeper per box, however many gunicorn workers are running
+    with open(GC_LOCK_PATH, "a") as lockf:
+        try:
+            fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+        conn = _gc_connect()
+        try:
+            return sweep_orphaned_uploads(conn)
+        finally:
+            conn.close()
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+def _gc_worker():
+    next_sweep = time.time() + 60
+    while True:
+        timeout = max(0.0, next_sweep - time.time())
+        try:
+            post_id = _gc_queue.get(timeout=timeout)
+        except queue.Empty:
+            post_id = None
+
+        try:
+            if post_id is not None:
+                conn = _gc_connect()
+                try:
+                    freed = purge_post(conn, post_id)
+                finally:
+                    conn.close()
+                print(f"GC_PURGE post={post_id} bytes={freed}")
+            elif time.time() >= next_sweep:
+                report = _gc_sweep_locked()
+                next_sweep = time.time() + GC_SWEEP_INTERVAL
+                if report:
+                    print(f"GC_SWEEP posts={report['posts']} files={report['files']} bytes={report['bytes']}")
+        except Exception as e:
+            print("GC error:", e)
+
+def start_background_gc():
+    global _gc_thread
+    with _gc_thread_lock:
+        if _gc_thread is None or not _gc_thread.is_alive():
+            _gc_thread = threading.Thread(target=_gc_worker, name="kidsta-gc", daemon=True)
+            _gc_thread.start()
+
+def enqueue_post_purge(post_id):
+    # without a running collector (scripts, the REPL) the tombstone is picked
+    # up by the server's next sweep instead
+    _gc_queue.put(post_id)
+
+# ---------- Friend suggestions (friends-of-friends) ----------
+# A daemon thread keeps friend_suggestions filled so /api/suggestions is one
+# indexed read. Edge changes mark the affected users in suggestion_dirty and
+# only those get recomputed; a full rebuild runs every few hours as a backstop.
+# The thread is started by start_background_workers().
+SUGGEST_PER_USER = 20
+SUGGEST_POLL_INTERVAL = 30            # seconds between dirty-queue checks
+SUGGEST_REBUILD_INTERVAL = 6 * 60 * 60
+SUGGEST_BATCH = 200
+SUGGEST_LOCK_PATH = os.path.join(RENDER_SCRATCH_ROOT, "suggest.lock")
+
+_suggest_wake = threading.Event()
+_suggest_thread = None
+_suggest_thread_lock = threading.Lock()
+
+def compute_suggestions(conn, user_id, limit=SUGGEST_PER_USER):
+    """
+    Rank friends-of-friends of user_id by mutual-friend count, skipping
+    existing friends, blocks either way and anyone with an open or denied
+    request between the two. Returns [(suggested_id, mutual_count)].
+    """
+    return conn.execute("""
+        WITH f(id) AS (
+            SELECT user_hi FROM friendships WHERE user_lo = :u
+            UNION ALL
+            SELECT user_lo FROM friendships WHERE user_hi = :u
+        ),
+        ff(id) AS (
+            SELECT s.user_hi FROM friendships s JOIN f ON s.user_lo = f.id
+            UNION ALL
+            SELECT s.user_lo FROM friendships s JOIN f ON s.user_hi = f.id
+        )
+        SELECT id, COUNT(*) AS mutual
+        FROM ff
+        WHERE id != :u
+          AND id NOT IN (SELECT id FROM f)
+          AND id NOT IN (SELECT blocked_id FROM blocks WHERE blocker_id = :u
+                         UNION SELECT blocker_id FROM blocks WHERE blocked_id = :u)
+          AND id NOT IN (SELECT to_id FROM friend_requests WHERE from_id = :u AND status != 'accepted'
+                         UNION SELECT from_id FROM friend_requests WHERE to_id = :u AND status != 'accepted')
+        GROUP BY id
+        ORDER BY mutual DESC, id
+        LIMIT :limit
+    """, {"u": user_id, "limit": limit}).fetchall()
+
+def refresh_suggestions(conn, user_ids):
+    """Recompute and store suggestions for user_ids. Commits."""
+    now = datetime.utcnow().isoformat()
+    for uid in user_ids:
+        rows = compute_suggestions(conn, uid)
+        conn.execute("DELETE FROM friend_suggestions WHERE user_id = ?", (uid,))
+        conn.executemany(
+            "INSERT INTO friend_suggestions (user_id, suggested_id, mutual_count, computed_at) VALUES (?, ?, ?, ?)",
+            [(uid, r[0], r[1], now) for r in rows]
+        )
+    conn.commit()
+
+def mark_suggestions_dirty(db, user_ids):
+    """Queue users for recompute (cross-worker, via the DB). Commits."""
+    now = datetime.utcnow().isoformat()
+    db.executemany("INSERT INTO suggestion_dirty (user_id, marked_at) VALUES (?, ?) "
+                   "ON CONFLICT (user_id) DO UPDATE SET marked_at = excluded.marked_at",
+                   [(uid, now) for uid in set(user_ids)])
+    db.commit()
+    _suggest_wake.set()
+
+def mark_edge_changed(db, a, b, friendship=False):
+    """
+    A request between a and b only changes their own lists; a new friendship
+    also changes the friends-of-friends of everyone already friends with them.
+    """
+    ids = {a, b}
+    if friendship:
+        ids.update(get_social_graph(a)[0])
+        ids.update(get_social_graph(b)[0])
+    mark_suggestions_dirty(db, ids)
+
+def _suggest_locked(full):
+    with open(SUGGEST_LOCK_PATH, "a") as lockf:
+        try:
+            fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return 0
+        conn = _gc_connect()
+        try:
+            if full:
+                ids = [r[0] for r in conn.execute("SELECT id FROM users")]
+                conn.execute("DELETE FROM suggestion_dirty")
+                conn.execute("DELETE FROM friend_suggestions WHERE user_id NOT IN (SELECT id FROM users)")
+                for i in range(0, len(ids), SUGGEST_BATCH):
+                    refresh_suggestions(conn, ids[i:i + SUGGEST_BATCH])
+                return len(ids)
+            done = 0
+            while True:
+                rows = conn.execute("SELECT user_id, marked_at FROM suggestion_dirty LIMIT ?", (SUGGEST_BATCH,)).fetchall()
+                if not rows:
+                    return done
+                refresh_suggestions(conn, [r[0] for r in rows])
+                # only clear marks that weren't re-set while we were computing
+                conn.executemany("DELETE FROM suggestion_dirty WHERE user_id = ? AND marked_at = ?",
+                                 [(r[0], r[1]) for r in rows])
+                conn.commit()
+                done += len(rows)
+        finally:
+            conn.close()
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+def _suggest_worker():
+    next_rebuild = time.time() + 60
+    while True:
+        _suggest_wake.wait(SUGGEST_POLL_INTERVAL)
+        _suggest_wake.clear()
+        try:
+            full = time.time() >= next_rebuild
+            t0 = time.time()
+            n = _suggest_locked(full)
+            if full:
+                next_rebuild = time.time() + SUGGEST_REBUILD_INTERVAL
+            if n:
+                print(f"SUGGEST_REFRESH users={n} full={int(full)} ms={(time.time() - t0) * 1000:.0f}")
+        except Exception as e:
+            print("Suggestion refresh error:", e)
+
+def start_background_suggestions():
+    global _suggest_thread
+    with _suggest_thread_lock:
+        if _suggest_thread is None or not _suggest_thread.is_alive():
+            _suggest_thread = threading.Thread(target=_suggest_worker, name="kidsta-suggest", daemon=True)
+            _suggest_thread.start()
+
+def get_friend_suggestions(user_id, limit=10):
+    """Stored suggestions joined to users, best first, minus fresh blocks/friends."""
+    rows = get_db().execute("""
+        SELECT u.id, u.display_name, u.kidsta_id, u.avatar_filename, s.mutual_count
+        FROM friend_suggestions s
+        JOIN users u ON u.id = s.suggested_id
+        WHERE s.user_id = ?
+        ORDER BY s.mutual_count DESC, s.suggested_id
+        LIMIT ?
+    """, (user_id, limit)).fetchall()
+    # the table can lag an edge change by one refresh; the cached graph can't
+    friends, blocked = get_social_graph(user_id)
+    return [r for r in rows if r["id"] not in friends and r["id"] not in blocked]
+
+# ---------- Render scratch helpers ----------
+def make_render_dir():
+    """Create a unique scratch directory for one render job."""
+    os.makedirs(RENDER_SCRATCH_ROOT, exist_ok=True)
+    return tempfile.mkdtemp(prefix=RENDER_DIR_PREFIX, dir=RENDER_SCRATCH_ROOT)
+
+def publish_render(src_path, out_name):
+    """
+    Move a finished render into its uploads shard atomically and return the
+    stored name. The scratch dir may be on another filesystem (tmpfs), so copy
+    to a hidden temp name next to the target first and os.replace() it.
+    """
+    stored, dest = new_upload_path(out_name)
+    try:
+        os.replace(src_path, dest)
+        return stored
+    except OSError:
+        pass
+    partial = os.path.join(os.path.dirname(dest), f".{out_name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        shutil.copyfile(src_path, partial)
+        os.replace(partial, dest)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return stored
+
+def cleanup_stale_renders(max_age=RENDER_STALE_SECONDS):
+    """
+    Startup janitor: remove render dirs (and legacy temp files in uploads)
+    that are older than max_age, i.e. left over from crashed workers.
+    Returns the number of entries removed.
+    """
+    cutoff = datetime.utcnow().timestamp() - max_age
+    removed = 0
+
+    try:
+        for name in os.listdir(RENDER_SCRATCH_ROOT):
+            path = os.path.join(RENDER_SCRATCH_ROOT, name)
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            if name.startswith(RENDER_DIR_PREFIX) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+            elif name.startswith(RENDER_PROGRESS_PREFIX) and os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+    except OSError:
+        pass
+
+    try:
+        for name in os.listdir(app.config["UPLOAD_FOLDER"]):
+            if not (name.startswith(LEGACY_RENDER_TEMP_PREFIXES) or name.endswith(".part")):
+                continue
+            path = os.path.join(app.config["UPLOAD_FOLDER"], name)
+            try:
+                if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    except OSError:
+        pass
+
+    return removed
+
+# ---------- Render progress (ffmpeg -progress -> SSE) ----------
+# A render's progress is a small JSON snapshot in RENDER_SCRATCH_ROOT, so any
+# worker on the box can serve the SSE stream while another one renders.
+# The page picks the job id, so snapshots are keyed by user id as well: a
+# user can only ever watch (or clash with) their own renders.
+RENDER_JOB_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+RENDER_PROGRESS_WRITE_INTERVAL = 0.25  # seconds between snapshot writes
+RENDER_PROGRESS_TIMEOUT = 15 * 60      # how long an SSE stream may stay open
+RENDER_PROGRESS_START_GRACE = 60       # give up if no snapshot appears by then
+# Each open stream holds a gthread worker thread on top of the render's own
+# POST, so only a few run per worker; past that /render_progress answers 503
+# and the page polls /api/render_progress instead.
+RENDER_PROGRESS_MAX_STREAMS = int(os.environ.get("KIDSTA_RENDER_MAX_STREAMS", "2"))
+RENDER_PROGRESS_POLL_SECONDS = 1.5
+SSE_HEARTBEAT_SECONDS = 15
+
+_render_streams = threading.BoundedSemaphore(RENDER_PROGRESS_MAX_STREAMS)
+
+def _progress_path(user_id, job_id):
+    return os.path.join(RENDER_SCRATCH_ROOT, f"{RENDER_PROGRESS_PREFIX}{int(user_id)}_{job_id}.json")
+
+def start_render_progress(job_id, user_id, total_seconds):
+    """
+    Create the progress record for a render. total_seconds is the amount of
+    media ffmpeg will process over all stages; percent is measured against it.
+    Returns the job dict (or None if job_id isn't usable).
+    """
+    if not job_id or not RENDER_JOB_RE.match(job_id):
+        return None
+    job = {
+        "id": job_id,
+        "user_id": user_id,
+        "state": "running",
+        "stage": "receive",
+        "total": max(float(total_seconds), 0.001),
+        "done": 0.0,
+        "percent": 0,
+        "stages": {},
+        "error": None,
+        "_stage_started": time.time(),
+        "_last_write": 0.0,
+    }
+    _write_render_progress(job, force=True)
+    return job
+
+def _write_render_progress(job, force=False):
+    if job is None:
+        return
+    now = time.time()
+    if not force and now - job["_last_write"] < RENDER_PROGRESS_WRITE_INTERVAL:
+        return
+    job["_last_write"] = now
+    job["percent"] = min(100, int(job["done"] * 100 / job["total"]))
+    snap = {k: v for k, v in job.items() if not k.startswith("_")}
+    path = _progress_path(job["user_id"], job["id"])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("render progress write failed:", e)
+
+def set_render_stage(job, stage):
+    """Close the timing of the current stage and start a new one."""
+    if job is None:
+        return
+    now = time.time()
+    prev = job["stage"]
+    job["stages"][prev] = round(job["stages"].get(prev, 0) + now - job["_stage_started"], 3)
+    job["stage"] = stage
+    job["_stage_started"] = now
+    _write_render_progress(job, force=True)
+
+def finish_render_progress(job, error=None):
+    if job is None:
+        return
+    set_render_stage(job, "finished")
+    job["stages"].pop("finished", None)
+    job["state"] = "error" if error else "done"
+    job["error"] = error
+    if not error:
+        job["done"] = job["total"]
+    _write_render_progress(job, force=True)
+    timings = " ".join(f"{k}={v:.2f}s" for k, v in job["stages"].items())
+    print(f"RENDER_TIMING job={job['id']} state={job['state']} {timings}")
+
+def render_progress_payload(snap):
+    """The client-facing part of a snapshot."""
+    return {k: snap.get(k) for k in ("state", "stage", "percent", "stages", "error")}
+
+def read_render_progress(user_id, job_id):
+    try:
+        with open(_progress_path(user_id, job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def probe_duration(path):
+    """
+    Media duration in seconds (float), or None if it can't be determined.
+    Uses ffprobe when available, otherwise parses `ffmpeg -i` output.
+    """
+    try:
+        proc = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=30
+        )
+        return float(proc.stdout.strip())
+    except (OSError, ValueError, subprocess.SubprocessError):
+        pass
+    try:
+        proc = subprocess.run(["ffmpeg", "-hide_banner", "-i", path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=30)
+        m = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", proc.stderr)
+        if m:
+            return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return None
+
+def run_ffmpeg(cmd, job=None, duration=None):
+    """
+    Run an ffmpeg command and return a CompletedProcess (stderr as text).
+    With a job, -progress output is parsed and `duration` seconds of the
+    job's total are credited as the output timestamp advances.
+    """
+    if job is None:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + list(cmd[1:])
+    base = job["done"]
+    duration = duration or 0.0
+    with tempfile.TemporaryFile("w+", encoding="utf-8", errors="replace") as errf:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errf, text=True)
+        for line in proc.stdout:
+            key, _, value = line.strip().partition("=")
+            if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                # both keys are microseconds in current ffmpeg builds
+                job["done"] = base + min(int(value) / 1000000.0, duration)
+                _write_render_progress(job)
+            elif key == "progress" and value == "end":
+                job["done"] = base + duration
+                _write_render_progress(job, force=True)
+        proc.wait()
+        errf.seek(0)
+        stderr = errf.read()
+    job["done"] = base + duration
+    return subprocess.CompletedProcess(cmd, proc.returncode, "", stderr)
+
+# ---------- Media metadata (size, placeholder colour, video poster) ----------
+# Computed once at upload and stored on post_media so feed cards can reserve
+# the box, paint a placeholder colour and show a poster without the browser
+# fetching the media first. Rows from before this existed are filled in by a
+# one-shot background pass that start_background_workers() kicks off.
+POSTER_WIDTH = 480
+MEDIA_META_BATCH = 50
+MEDIA_META_START_DELAY = 20  # let the first request run init_db() first
+MEDIA_META_RETRY_SECONDS = 24 * 60 * 60
+MEDIA_META_LOCK_PATH = os.path.join(RENDER_SCRATCH_ROOT, "media_meta.lock")
+
+_media_meta_thread = None
+_media_meta_thread_lock = threading.Lock()
+
+def _image_metadata(path):
+    """(width, height, '#rrggbb') of an image as displayed, or (None, None, None)."""
+    try:
+        with Image.open(path) as im:
+            w, h = im.size
+            try:
+                if im.getexif().get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:
+                    w, h = h, w
+            except Exception:
+                pass
+            if im.format == "JPEG":
+                im.draft("RGB", (64, 64))
+            im = im.convert("RGB")
+            im.thumbnail((64, 64))
+            r, g_, b = im.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+            return w, h, f"#{r:02x}{g_:02x}{b:02x}"
+    except Exception as e:
+        print("image metadata failed:", e)
+        return None, None, None
+
+def _video_poster(path, name):
+    """Grab an early frame as a small JPEG upload; returns its stored name or None."""
+    poster_name, poster_path = new_upload_path(f"poster_{os.path.splitext(os.path.basename(name))[0]}.jpg")
+    for seek in (["-ss", "0.5"], []):  # clips shorter than the seek have no frame there
+        proc = subprocess.run(
+            ["ffmpeg", "-y", "-v", "error"] + seek + ["-i", path, "-frames:v", "1",
+             "-vf", f"scale='min({POSTER_WIDTH},iw)':-2", "-q:v", "5", poster_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        if proc.returncode == 0 and os.path.exists(poster_path) and os.path.getsize(poster_path):
+            return poster_name
+    return None
+
+def mp4_header_bytes(path):
+    """
+    Offset of the first mdat box when moov comes before it (a "faststart"
+    MP4 that can start playing from its first bytes), else None.
+    """
+    try:
+        with open(path, "rb") as f:
+            total = os.fstat(f.fileno()).st_size
+            pos, seen_moov = 0, False
+            while pos + 8 <= total:
+                f.seek(pos)
+                size, kind = struct.unpack(">I4s", f.read(8))
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0]
+                elif size == 0:
+                    size = total - pos
+                if kind == b"moov":
+                    seen_moov = True
+                elif kind == b"mdat":
+                    return pos if seen_moov else None
+                if size < 8:
+                    return None
+                pos += size
+    except (OSError, struct.error):
         pass
+    return None
+
+MEDIA_META_COLUMNS = ("width", "height", "placeholder", "poster", "duration", "bytes", "header_bytes")
+
+def media_metadata(filename, media_type):
+    """MEDIA_META_COLUMNS -> value for an upload; unknowns are None."""
+    meta = dict.fromkeys(MEDIA_META_COLUMNS)
+    path = os.path.join(app.config["UPLOAD_FOLDER"], resolve_upload_name(filename))
+    if not os.path.isfile(path):
+        return meta
+    meta["bytes"] = os.path.getsize(path)
+    if media_type == "image":
+        meta["width"], meta["height"], meta["placeholder"] = _image_metadata(path)
+    elif media_type == "video":
+        try:
+            meta["poster"] = _video_poster(path, filename)
+        except (OSError, subprocess.SubprocessError) as e:
+            print("video poster failed:", e)
+        if meta["poster"]:
+            # the poster is the displayed (rotation-applied) frame scaled down; its
+            # aspect ratio is what the box needs
+            poster_path = os.path.join(app.config["UPLOAD_FOLDER"], meta["poster"])
+            meta["width"], meta["height"], meta["placeholder"] = _image_metadata(poster_path)
+        meta["duration"] = probe_duration(path)
+        meta["header_bytes"] = mp4_header_bytes(path)
+    return meta
+
+def media_meta_complete(meta, media_type):
+    """Whether media_metadata() got what the cards need (else: retry later)."""
+    if media_type == "image":
+        return meta["width"] is not None
+    if media_type == "video":
+        return meta["poster"] is not None or meta["duration"] is not None
+    return meta["bytes"] is not None
+
+def add_post_media(db, post_id, filename, media_type, ord_idx, created_at, meta):
+    """
+    Insert a post_media row with `meta` from media_metadata(). No commit.
+    Compute meta before the first write of the request: it can run ffmpeg,
+    and sqlite holds the write lock from that first write until commit.
+    """
+    # an incomplete result leaves meta_at NULL so the backfill tries again
+    meta_at = datetime.utcnow().isoformat() if media_meta_complete(meta, media_type) else None
+    db.execute(f"""
+        INSERT INTO post_media (post_id, filename, media_type, ord, created_at, meta_at,
+                                {", ".join(MEDIA_META_COLUMNS)})
+        VALUES (?, ?, ?, ?, ?, ?, {", ".join("?" * len(MEDIA_META_COLUMNS))})
+    """, (post_id, filename, media_type, ord_idx, created_at, meta_at,
+          *(meta[c] for c in MEDIA_META_COLUMNS)))
+
+def backfill_media_metadata():
+    """
+    Fill metadata for post_media rows that don't have it. Rows that still
+    come back incomplete get meta_failed_at and are skipped until
+    MEDIA_META_RETRY_SECONDS later; only filled rows bump their post's
+    version. Returns rows filled.
+    """
+    with open(MEDIA_META_LOCK_PATH, "a") as lockf:
+        try:
+            fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return 0
+        conn = _gc_connect()
+        done = 0
+        try:
+            while True:
+                retry_cutoff = (datetime.utcnow() - timedelta(seconds=MEDIA_META_RETRY_SECONDS)).isoformat()
+                rows = conn.execute("""
+                    SELECT id, post_id, filename, media_type FROM post_media
+                    WHERE meta_at IS NULL AND (meta_failed_at IS NULL OR meta_failed_at < ?)
+                    LIMIT ?
+                """, (retry_cutoff, MEDIA_META_BATCH)).fetchall()
+                if not rows:
+                    return done
+                # ffmpeg runs here, outside any write transaction
+                metas = [(r, media_metadata(r["filename"], r["media_type"])) for r in rows]
+                now = datetime.utcnow().isoformat()
+                for r, meta in metas:
+                    if not media_meta_complete(meta, r["media_type"]):
+                        conn.execute("UPDATE post_media SET meta_failed_at = ? WHERE id = ?", (now, r["id"]))
+                        continue
+                    conn.execute(f"""
+                        UPDATE post_media SET meta_at = ?, meta_failed_at = NULL,
+                            {", ".join(c + " = ?" for c in MEDIA_META_COLUMNS)}
+                        WHERE id = ?
+                    """, (now, *(meta[c] for c in MEDIA_META_COLUMNS), r["id"]))
+                    bump_post_version(conn, r["post_id"])  # re-render the cached card
+                    done += 1
+                conn.commit()
+        finally:
+            conn.close()
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+def _media_meta_worker():
+    time.sleep(MEDIA_META_START_DELAY)
+    try:
+        t0 = time.time()
+        n = backfill_media_metadata()
+        if n:
+            print(f"MEDIA_META_BACKFILL filled={n} ms={(time.time() - t0) * 1000:.0f}")
+    except Exception as e:
+        print("Media metadata backfill error:", e)
+
+def start_background_media_meta():
+    global _media_meta_thread
+    with _media_meta_thread_lock:
+        if _media_meta_thread is None or not _media_meta_thread.is_alive():
+            _media_meta_thread = threading.Thread(target=_media_meta_worker, name="kidsta-media-meta", daemon=True)
+            _media_meta_thread.start()
 
 # ---------- Copyright-check helper (unchanged) ----------
 def check_copyright(video_path, snippet_start_seconds=5, snippet_duration=10):
@@ -366,6 +1729,23 @@ def check_copyright(video_path, snippet_start_seconds=5, snippet_duration=10):
         except Exception:
             pass
 
+SLIDESHOW_PHOTO_SECONDS = 3
+SLIDESHOW_MAX_SECONDS = 60  # the UI promises "Final video max: 60 seconds"
+SLIDESHOW_FPS = 30          # common frame rate so concat timestamps line up
+
+def plan_clip_seconds(duration, planned, cap=SLIDESHOW_MAX_SECONDS):
+    """
+    How many seconds of an input to keep, given `planned` seconds already
+    scheduled. Unknown durations (None/0) get whatever is left of the cap.
+    Returns 0 when the input won't make it into the final video at all.
+    """
+    remaining = cap - planned
+    if remaining <= 0:
+        return 0
+    if not duration or duration <= 0:
+        return remaining
+    return min(duration, remaining)
+
 @app.route("/make_slideshow", methods=["POST"])
 def make_slideshow():
     init_db()
@@ -380,15 +1760,19 @@ def make_slideshow():
     def safe_name(n):
         return "".join(c if (c.isalnum() or c in "._-") else "_" for c in n)
 
+    inputs = []          # (kind, path, seconds to keep) saved into the scratch dir
+    planned = 0.0        # seconds of final video scheduled so far
+    trimmed = False      # True if the cap cut or dropped anything
     tmp_items = []       # paths to parts that will be concatenated
-    tmp_to_cleanup = []  # files to remove in finally
+    job_dir = None       # private scratch dir, removed in finally
+    job = None           # progress record, see start_render_progress()
 
     try:
-        # re-read/confirm incoming params
-        song = (request.form.get("song") or "").strip()
-
-        # 1) Read incoming photos (data-URL) and uploaded files
-        photos = []
+        # 1) Read incoming photos and uploaded files.
+        # Camera captures arrive as binary "photo" parts (canvas.toBlob) that
+        # Werkzeug has already spooled to disk. Older clients still send
+        # base64 data-URLs in photo0..photoN form fields.
+        photos = [f for f in request.files.getlist("photo") if f and f.filename]
         try:
             count = int(request.form.get("count", 0))
         except Exception:
@@ -404,126 +1788,150 @@ def make_slideshow():
         if not photos and not uploaded_files:
             return jsonify({"ok": False, "error": "no valid photos or media provided"}), 400
 
-        os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-
-        # Convert data-URL photos -> short mp4s (3s)
-        import base64, subprocess, shutil
-        for idx, data_url in enumerate(photos):
-            try:
-                header, b64 = data_url.split(",", 1)
-                img_bytes = base64.b64decode(b64)
-            except Exception:
+        # every intermediate file for this render lives in its own directory
+        job_dir = make_render_dir()
+        job_id = (request.form.get("job") or "").strip()
+        receive_started = time.time()
+
+        # 2) Put the parts in the order the user arranged them: the client sends
+        # one "order" field ("photo" / "media") per item. Parts it doesn't
+        # cover (older clients) follow: captures first, then uploads.
+        queues = {"photo": list(photos), "media": list(uploaded_files)}
+        items = []
+        for source in request.form.getlist("order"):
+            if queues.get(source):
+                items.append((source, queues[source].pop(0)))
+        items += [("photo", p) for p in queues["photo"]] + [("media", f) for f in queues["media"]]
+
+        # 3) Save each item (stills normalized, videos as-is). Inputs are
+        # planned against the cap as they arrive; anything past it is never
+        # decoded or encoded.
+        for idx, (source, part) in enumerate(items):
+            if planned >= SLIDESHOW_MAX_SECONDS:
+                trimmed = True
+                break
+            if source == "photo":
+                take = plan_clip_seconds(SLIDESHOW_PHOTO_SECONDS, planned)
+                img_path = os.path.join(job_dir, f"photo_{idx}.jpg")
+                if isinstance(part, str):
+                    # compatibility: data-URL form field
+                    try:
+                        header, b64 = part.split(",", 1)
+                        img_bytes = base64.b64decode(b64)
+                    except Exception:
+                        continue
+                    part = BytesIO(img_bytes)
+                    del img_bytes
+                # decodes straight from the spooled part; never holds the raw bytes
+                save_image_safely(part, img_path)
+                inputs.append(("photo", img_path, take))
+                planned += take
                 continue
-            fname = f"photo_{idx}_{int(datetime.utcnow().timestamp())}.jpg"
-            img_path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
-            with open(img_path, "wb") as f:
-                f.write(img_bytes)
-
-            out_tmp = os.path.join(app.config["UPLOAD_FOLDER"], f"tmp_img_{idx}_{int(datetime.utcnow().timestamp())}.mp4")
-            cmd = [
-                "ffmpeg", "-y",
-                "-loop", "1",
-                "-i", img_path,
-                "-c:v", "libx264",
-                "-t", "3",
-                "-pix_fmt", "yuv420p",
-                "-vf", "scale=720:1280,setsar=1",
-                out_tmp
-            ]
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            if os.path.exists(out_tmp):
-                tmp_items.append(out_tmp)
-                tmp_to_cleanup.extend([img_path, out_tmp])
-            else:
-                tmp_to_cleanup.append(img_path)
 
-        # 3) Process uploaded files (images -> short mp4; videos -> re-encode full length)
-        for fidx, fobj in enumerate(uploaded_files):
-            if not fobj or not getattr(fobj, "filename", None):
+            if not part or not getattr(part, "filename", None):
                 continue
-            orig = secure_filename(fobj.filename)
-            stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            saved = os.path.join(app.config["UPLOAD_FOLDER"], f"{stamp}_{safe_name(orig)}")
-            fobj.save(saved)
-
+            orig = secure_filename(part.filename)
             ext = orig.rsplit(".", 1)[-1].lower() if "." in orig else ""
 
             if ext in ("png", "jpg", "jpeg", "gif", "webp", "bmp"):
-                out_tmp = os.path.join(app.config["UPLOAD_FOLDER"], f"tmp_upimg_{fidx}_{stamp}.mp4")
+                # decode at reduced size straight from the upload stream
+                saved = os.path.join(job_dir, f"upload_{idx}_norm.jpg")
+                save_image_safely(part, saved)
+                take = plan_clip_seconds(SLIDESHOW_PHOTO_SECONDS, planned)
+                inputs.append(("image", saved, take))
+            else:
+                saved = os.path.join(job_dir, f"upload_{idx}_{safe_name(orig)}")
+                part.save(saved)
+                duration = probe_duration(saved)
+                take = plan_clip_seconds(duration, planned)
+                if duration and take < duration:
+                    trimmed = True
+                inputs.append(("video", saved, take))
+            planned += take
+
+        # ----- Resolve song_path early if a song name provided -----
+        if song:
+            # try exact, safe-name, and common extensions
+            audio_dir = os.path.join(BASE_DIR, "static", "audio_library")
+            candidate = os.path.join(audio_dir, song)
+            if os.path.exists(candidate):
+                song_path = candidate
+            else:
+                song_safe = safe_name(song)
+                alt = os.path.join(audio_dir, song_safe)
+                if os.path.exists(alt):
+                    song_path = alt
+                else:
+                    # try common extensions appended to safe name
+                    for ext in ("mp3", "m4a", "wav", "aac", "ogg"):
+                        candidate_ext = os.path.join(audio_dir, f"{song_safe}.{ext}")
+                        if os.path.exists(candidate_ext):
+                            song_path = candidate_ext
+                            break
+            # if still None, we'll just ignore replacing audio later (no crash)
+
+        # Total media seconds ffmpeg will chew through: every clip once, then
+        # the concatenation once more. Bounded by the cap, not by input size.
+        clip_seconds = sum(sec for _, _, sec in inputs)
+        job = start_render_progress(job_id, user["id"], clip_seconds * 2)
+        if job:
+            job["_stage_started"] = receive_started
+        set_render_stage(job, "clips")
+
+        # 4) Encode each input into a uniform 720x1280 clip
+        for idx, (kind, saved, seconds) in enumerate(inputs):
+            out_tmp = os.path.join(job_dir, f"clip_{idx}.mp4")
+            if kind in ("photo", "image"):
+                # camera captures are already fitted inside 720x1280 by
+                # normalize_image, so they get the same fit+pad as images
                 cmd = [
                     "ffmpeg", "-y",
                     "-loop", "1",
                     "-i", saved,
                     "-c:v", "libx264",
-                    "-t", "3",
+                    "-t", f"{seconds:.3f}",
                     "-pix_fmt", "yuv420p",
-                    "-vf", "scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2",
+                    "-vf", f"scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2,fps={SLIDESHOW_FPS}",
                     out_tmp
                 ]
-                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                if os.path.exists(out_tmp):
-                    tmp_items.append(out_tmp)
-                    tmp_to_cleanup.extend([saved, out_tmp])
-                else:
-                    tmp_items.append(saved)
-                    tmp_to_cleanup.append(saved)
             else:
-                out_tmp = os.path.join(app.config["UPLOAD_FOLDER"], f"tmp_upvid_{fidx}_{stamp}.mp4")
+                # -t before -i: the demuxer stops reading once `seconds` is
+                # reached, so the tail of a long clip is never decoded
                 cmd = [
                     "ffmpeg", "-y",
+                    "-t", f"{seconds:.3f}",
                     "-i", saved,
                     "-c:v", "libx264",
                     "-preset", "veryfast",
                     "-crf", "23",
                     "-pix_fmt", "yuv420p",
-                    "-vf", "scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2",
+                    "-vf", f"scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2,fps={SLIDESHOW_FPS}",
                     "-c:a", "aac",
                     "-b:a", "128k",
                     out_tmp
                 ]
-                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                if os.path.exists(out_tmp):
-                    tmp_items.append(out_tmp)
-                    tmp_to_cleanup.extend([saved, out_tmp])
-                else:
-                    tmp_items.append(saved)
-                    tmp_to_cleanup.append(saved)
+            run_ffmpeg(cmd, job, seconds)
+            if os.path.exists(out_tmp):
+                tmp_items.append(out_tmp)
+            elif kind != "photo":
+                tmp_items.append(saved)
 
         if len(tmp_items) == 0:
+            finish_render_progress(job, "no valid media after processing")
             return jsonify({"ok": False, "error": "no valid media after processing"}), 400
 
-        # 4) Write concat list file for ffmpeg concat demuxer
-        list_file = os.path.join(app.config["UPLOAD_FOLDER"], f"concat_{int(datetime.utcnow().timestamp())}.txt")
+        # 5) Write concat list file for ffmpeg concat demuxer
+        list_file = os.path.join(job_dir, "concat.txt")
         with open(list_file, "w", encoding="utf-8") as lf:
             for p in tmp_items:
                 lf.write(f"file '{p}'\n")
-        tmp_to_cleanup.append(list_file)
 
-        out_name = f"slideshow_{int(datetime.utcnow().timestamp())}.mp4"
-        out_path = os.path.join(app.config["UPLOAD_FOLDER"], out_name)
+        out_name = f"slideshow_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.mp4"
+        out_path = os.path.join(job_dir, out_name)
 
-        # ----- Resolve song_path early if a song name provided -----
-        if song:
-            # try exact, safe-name, and common extensions
-            audio_dir = os.path.join(BASE_DIR, "static", "audio_library")
-            candidate = os.path.join(audio_dir, song)
-            if os.path.exists(candidate):
-                song_path = candidate
-            else:
-                song_safe = safe_name(song)
-                alt = os.path.join(audio_dir, song_safe)
-                if os.path.exists(alt):
-                    song_path = alt
-                else:
-                    # try common extensions appended to safe name
-                    for ext in ("mp3", "m4a", "wav", "aac", "ogg"):
-                        candidate_ext = os.path.join(audio_dir, f"{song_safe}.{ext}")
-                        if os.path.exists(candidate_ext):
-                            song_path = candidate_ext
-                            break
-            # if still None, we'll just ignore replacing audio later (no crash)
-
-        # 5) Re-encode final file using concat (keeps full lengths)
+        # 6) Re-encode final file using concat; the song (if any) is muxed in
+        # this same pass, and -t guards the cap if a probe under-reported.
+        set_render_stage(job, "concat")
         if song_path:
             cmd = [
                 "ffmpeg", "-y",
@@ -535,6 +1943,8 @@ def make_slideshow():
                 "-c:a", "aac", "-b:a", "128k",
                 "-pix_fmt", "yuv420p",
                 "-shortest",
+                "-t", str(SLIDESHOW_MAX_SECONDS),
+                "-movflags", "+faststart",
                 out_path
             ]
         else:
@@ -544,79 +1954,559 @@ def make_slideshow():
                 "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
                 "-c:a", "aac", "-b:a", "128k",
                 "-pix_fmt", "yuv420p",
+                "-t", str(SLIDESHOW_MAX_SECONDS),
+                "-movflags", "+faststart",
                 out_path
             ]
 
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        proc = run_ffmpeg(cmd, job, clip_seconds)
 
         if proc.returncode != 0 or not os.path.exists(out_path):
+            finish_render_progress(job, "ffmpeg failed to create final video")
             # include stderr to help debug
             return jsonify({"ok": False, "error": "ffmpeg failed to create final video", "details": proc.stderr[:1000]}), 500
 
-        # 6) If we encoded without the song earlier, but want to replace audio now, do a safe remux (only if song_path exists)
-        if song and song_path and os.path.exists(out_path):
-            merged = os.path.join(app.config["UPLOAD_FOLDER"], f"merged_{int(datetime.utcnow().timestamp())}.mp4")
-            cmdm = [
-                "ffmpeg", "-y",
-                "-i", out_path,
-                "-i", song_path,
-                "-map", "0:v:0",
-                "-map", "1:a:0",
-                "-c:v", "libx264",
-                "-preset", "veryfast",
-                "-crf", "23",
-                "-c:a", "aac",
-                "-b:a", "192k",
-                "-shortest",
-                merged
-            ]
-            procm = subprocess.run(cmdm, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if procm.returncode == 0 and os.path.exists(merged):
-                try:
-                    os.replace(merged, out_path)
-                except Exception:
-                    try:
-                        shutil.copyfile(merged, out_path)
-                        os.remove(merged)
-                    except Exception:
-                        pass
+        # 7) Publish the finished file into uploads in one atomic step
+        set_render_stage(job, "publish")
+        out_name = publish_render(out_path, out_name)
 
-        # 7) Insert DB row for the created file
+        # 8) Insert DB row for the created file
         caption = "Photo/Video Slideshow"
         if song:
             caption += f" · Song: {song}"
+        meta = media_metadata(out_name, "video")  # ffmpeg; keep it out of the write transaction
         created_at = datetime.utcnow().isoformat()
         db = get_db()
         try:
-            db.execute(
+            cur = db.execute(
                 "INSERT INTO posts (user_id, caption, media_filename, created_at, visibility) VALUES (?, ?, ?, ?, ?)",
                 (user["id"], caption, out_name, created_at, "public")
             )
         except Exception:
-            db.execute(
+            cur = db.execute(
                 "INSERT INTO posts (user_id, caption, media_filename, created_at) VALUES (?, ?, ?, ?)",
                 (user["id"], caption, out_name, created_at)
             )
+        add_post_media(db, cur.lastrowid, out_name, "video", 1, created_at, meta)
         db.commit()
 
-        return jsonify({"ok": True, "video": f"/uploads/{out_name}", "file": out_name})
+        finish_render_progress(job)
+        return jsonify({"ok": True, "video": f"/uploads/{out_name}", "file": out_name, "trimmed": trimmed})
 
     except Exception as e:
         print("MAKE_SLIDESHOW ERROR:", str(e))
+        finish_render_progress(job, "server processing error")
         return jsonify({"ok": False, "error": "server processing error: " + str(e)}), 500
 
     finally:
-        # cleanup temporary files
+        # the whole scratch dir goes, whatever state the render ended in
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+@app.route("/render_progress/<job_id>")
+def render_progress(job_id):
+    """
+    Server-Sent Events stream of one render's progress snapshots.
+    The page opens this before posting to /make_slideshow with the same job id,
+    so it waits for the record to appear -- but only RENDER_PROGRESS_START_GRACE
+    seconds; after that it sends state "missing" and ends. 503 when this
+    worker already runs RENDER_PROGRESS_MAX_STREAMS streams.
+    """
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    if not RENDER_JOB_RE.match(job_id):
+        return jsonify({"ok": False, "error": "bad job id"}), 404
+    if not _render_streams.acquire(blocking=False):
+        response = jsonify({"ok": False, "error": "busy", "retry": RENDER_PROGRESS_POLL_SECONDS})
+        response.status_code = 503
+        response.headers["Retry-After"] = "2"
+        return response
+
+    def stream():
+        started = time.time()
+        deadline = started + RENDER_PROGRESS_TIMEOUT
+        last = None
+        last_sent = started
+        yield "retry: 2000\n\n"
+        while time.time() < deadline:
+            snap = read_render_progress(uid, job_id)
+            if snap is None and last is None and time.time() - started >= RENDER_PROGRESS_START_GRACE:
+                yield f"data: {json.dumps({'state': 'missing'})}\n\n"
+                return
+            if snap and snap != last:
+                last = snap
+                last_sent = time.time()
+                yield f"data: {json.dumps(render_progress_payload(snap))}\n\n"
+                if snap.get("state") in ("done", "error"):
+                    return
+            elif time.time() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                last_sent = time.time()
+                yield ": heartbeat\n\n"
+            time.sleep(0.5)
+
+    response = Response(stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(_release_once(_render_streams))
+    return response
+
+@app.route("/api/render_progress/<job_id>")
+def api_render_progress(job_id):
+    """
+    One progress snapshot as JSON, for pages that can't get a stream.
+    state is "pending" until the render has started; `retry` is the
+    suggested poll interval in seconds.
+    """
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    if not RENDER_JOB_RE.match(job_id):
+        return jsonify({"ok": False, "error": "bad job id"}), 404
+    snap = read_render_progress(uid, job_id)
+    payload = render_progress_payload(snap) if snap else {"state": "pending"}
+    response = jsonify({"ok": True, "retry": RENDER_PROGRESS_POLL_SECONDS, **payload})
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+# ---------- Live events (pub/sub -> SSE / long-poll) ----------
+# create_notification() and the like/comment routes publish small JSON events
+# on channels ("user:<id>", "post:<id>"). Every worker keeps recent events in
+# an in-memory ring that /events (SSE) and /api/events/poll (long-poll) read.
+# KIDSTA_EVENT_BACKEND chooses how published events reach the rings:
+#   memory - straight into this process's ring (single worker; default)
+#   sqlite - appended to live_events and tailed by each worker, so all
+#            gunicorn workers on the box see every event
+# An open stream or a waiting long-poll holds a gthread worker thread, so
+# only EVENT_MAX_WAITERS of them run per worker at once. Past that /events
+# answers 503 and /api/events/poll returns immediately with a retry hint;
+# the client (static/live_events.js) then drops to plain interval polling.
+EVENT_BACKEND = os.environ.get("KIDSTA_EVENT_BACKEND", "memory").lower()
+EVENT_RING_SIZE = 2000
+EVENT_POLL_TIMEOUT = 25               # long-poll wait, seconds
+EVENT_STREAM_TIMEOUT = 5 * 60         # SSE streams end and the browser reconnects
+EVENT_MAX_WAITERS = int(os.environ.get("KIDSTA_EVENT_MAX_WAITERS", "2"))  # keep well under --threads
+EVENT_BUSY_RETRY_SECONDS = 15
+EVENT_PUMP_INTERVAL = 0.5
+EVENT_RETENTION_SECONDS = 10 * 60
+EVENT_MAX_POST_CHANNELS = 50
+
+class EventHub:
+    """Per-process ring of (seq, channel, data) that waiters block on."""
+
+    def __init__(self, size=EVENT_RING_SIZE):
+        self._ring = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self.last_seq = 0
+
+    def deliver(self, seq, channel, data):
+        with self._cond:
+            self._ring.append((seq, channel, data))
+            self.last_seq = max(self.last_seq, seq)
+            self._cond.notify_all()
+
+    def wait(self, channels, after, timeout):
+        """Events on `channels` newer than `after`, waiting up to `timeout` for one."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                found = [e for e in self._ring if e[0] > after and e[1] in channels]
+                remaining = deadline - time.time()
+                if found or remaining <= 0:
+                    return found
+                self._cond.wait(remaining)
+
+class MemoryEventBackend:
+    def __init__(self, hub):
+        self.hub = hub
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def start(self):
+        pass
+
+    def publish(self, channel, data):
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        self.hub.deliver(seq, channel, data)
+
+class SqliteEventBackend:
+    """
+    Local stand-in broker: publish appends to live_events, and a pump thread
+    in each worker tails the table into its hub. Row ids are the sequence
+    numbers, so a reconnect's Last-Event-ID is valid on any worker.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self._thread = None
+
+    def start(self):
+        conn = _gc_connect()
         try:
-            for p in tmp_to_cleanup:
-                if os.path.exists(p):
-                    try:
-                        os.remove(p)
-                    except:
-                        pass
-        except:
-            pass
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS live_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """)
+            conn.commit()
+            last = conn.execute("SELECT COALESCE(MAX(id), 0) FROM live_events").fetchone()[0]
+        finally:
+            conn.close()
+        self.hub.last_seq = last
+        self._thread = threading.Thread(target=self._pump, args=(last,), name="kidsta-events", daemon=True)
+        self._thread.start()
+
+    def publish(self, channel, data):
+        conn = _gc_connect()
+        try:
+            conn.execute("INSERT INTO live_events (channel, payload, created_at) VALUES (?, ?, ?)",
+                         (channel, json.dumps(data), time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _pump(self, last):
+        conn = _gc_connect()
+        next_prune = time.time() + 60
+        while True:
+            try:
+                rows = conn.execute("SELECT id, channel, payload FROM live_events WHERE id > ? ORDER BY id LIMIT 500",
+                                    (last,)).fetchall()
+                for r in rows:
+                    last = r["id"]
+                    self.hub.deliver(r["id"], r["channel"], json.loads(r["payload"]))
+                if time.time() >= next_prune:
+                    conn.execute("DELETE FROM live_events WHERE created_at < ?", (time.time() - EVENT_RETENTION_SECONDS,))
+                    conn.commit()
+                    next_prune = time.time() + 60
+                if rows:
+                    continue
+            except Exception as e:
+                print("Event pump error:", e)
+            time.sleep(EVENT_PUMP_INTERVAL)
+
+EVENT_BACKENDS = {
+    "memory": MemoryEventBackend,
+    "sqlite": SqliteEventBackend,
+}
+
+event_hub = EventHub()
+event_backend = EVENT_BACKENDS.get(EVENT_BACKEND, MemoryEventBackend)(event_hub)
+event_backend.start()
 
+def publish_event(channel, data):
+    try:
+        event_backend.publish(channel, data)
+    except Exception as e:
+        print("publish_event error:", e)
+
+def publish_post_counts(post_id, likes=None, dislikes=None):
+    if likes is None or dislikes is None:
+        likes, dislikes = get_vote_counts(post_id)
+    publish_event(f"post:{post_id}", {
+        "type": "post_counts",
+        "post_id": post_id,
+        "likes": likes,
+        "dislikes": dislikes,
+        "comments": get_comment_count(post_id),
+    })
+
+def _event_channels(uid):
+    channels = {f"user:{uid}"}
+    ids = {int(pid) for pid in request.args.get("posts", "").split(",")[:EVENT_MAX_POST_CHANNELS]
+           if pid.strip().isdigit()}
+    if ids:
+        # only posts the user may see, or counts of friends-only posts leak
+        rows = get_db().execute(f"""
+            SELECT id, user_id, visibility FROM posts
+            WHERE id IN ({", ".join("?" * len(ids))}) AND deleted_at IS NULL
+        """, sorted(ids)).fetchall()
+        channels.update(f"post:{r['id']}" for r in rows
+                        if can_view_post(uid, r["user_id"], r["visibility"]))
+    return channels
+
+def _event_cursor(raw):
+    # no cursor (or one from before a restart) means "from now"
+    try:
+        after = int(raw)
+    except (TypeError, ValueError):
+        return event_hub.last_seq
+    return min(after, event_hub.last_seq)
+
+_event_waiters = threading.BoundedSemaphore(EVENT_MAX_WAITERS)
+
+def _release_once(sem):
+    done = []
+    def release():
+        if not done:
+            done.append(True)
+            sem.release()
+    return release
+
+@app.route("/events")
+def events():
+    """SSE stream of the user's notification events plus counters for ?posts=1,2,3."""
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    if not _event_waiters.acquire(blocking=False):
+        response = jsonify({"ok": False, "error": "busy", "retry": EVENT_BUSY_RETRY_SECONDS})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(EVENT_BUSY_RETRY_SECONDS)
+        return response
+    channels = _event_channels(uid)
+    after = _event_cursor(request.headers.get("Last-Event-ID") or request.args.get("after"))
+
+    def stream(after):
+        deadline = time.time() + EVENT_STREAM_TIMEOUT
+        yield "retry: 3000\n\n"
+        while time.time() < deadline:
+            batch = event_hub.wait(channels, after, SSE_HEARTBEAT_SECONDS)
+            if not batch:
+                yield ": heartbeat\n\n"
+                continue
+            for seq, channel, data in batch:
+                after = seq
+                yield f"id: {seq}\ndata: {json.dumps(data)}\n\n"
+
+    response = Response(stream(after), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # the server closes the response even if the generator never started
+    response.call_on_close(_release_once(_event_waiters))
+    return response
+
+@app.route("/api/events/poll")
+def api_events_poll():
+    """
+    Events after ?after=. With a free waiter slot it long-polls (up to
+    ?wait= / EVENT_POLL_TIMEOUT seconds); otherwise it answers at once and
+    `retry` tells the client how long to sleep before asking again.
+    """
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    after = _event_cursor(request.args.get("after"))
+    wait = max(0, min(request.args.get("wait", EVENT_POLL_TIMEOUT, type=int), EVENT_POLL_TIMEOUT))
+    retry = 0
+    if wait and _event_waiters.acquire(blocking=False):
+        try:
+            batch = event_hub.wait(_event_channels(uid), after, wait)
+        finally:
+            _event_waiters.release()
+    else:
+        batch = event_hub.wait(_event_channels(uid), after, 0)
+        retry = EVENT_BUSY_RETRY_SECONDS
+    return jsonify({
+        "ok": True,
+        "last": batch[-1][0] if batch else after,
+        "events": [data for seq, channel, data in batch],
+        "retry": retry,
+    })
+
+
+# ---------- Fragment cache (rendered post cards) ----------
+# home() and profile() render each post card through cached_fragment(),
+# keyed by (template, post id, posts.version, whatever else the card shows
+# that isn't the post's own: author name/avatar, viewer state). A per-worker
+# LRU bounded by entries and bytes sits in front of an optional shared
+# backend (KIDSTA_FRAGMENT_CACHE=sqlite: one cache file per box, in the
+# render scratch dir, shared by all gunicorn workers).
+FRAGMENT_CACHE_BACKEND = os.environ.get("KIDSTA_FRAGMENT_CACHE", "memory").lower()
+FRAGMENT_CACHE_MAX_ITEMS = 5000
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+FRAGMENT_SHARED_PATH = os.path.join(RENDER_SCRATCH_ROOT, "fragments.db")
+FRAGMENT_SHARED_TTL = 60 * 60
+
+class MemoryFragmentCache:
+    def __init__(self, max_items=FRAGMENT_CACHE_MAX_ITEMS, max_bytes=FRAGMENT_CACHE_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> html
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = html
+            self._bytes += len(html)
+            while self._items and (len(self._items) > self.max_items or self._bytes > self.max_bytes):
+                _, dropped = self._items.popitem(last=False)
+                self._bytes -= len(dropped)
+
+class SqliteFragmentCache:
+    """Box-wide cache file; entries expire after FRAGMENT_SHARED_TTL."""
+
+    def __init__(self, path=FRAGMENT_SHARED_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS fragments (key TEXT PRIMARY KEY, html TEXT NOT NULL, stored_at REAL NOT NULL)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT html FROM fragments WHERE key = ? AND stored_at > ?",
+                                   (key, time.time() - FRAGMENT_SHARED_TTL)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, html):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO fragments (key, html, stored_at) VALUES (?, ?, ?)", (key, html, time.time()))
+        self._writes += 1
+        if self._writes % 500 == 0:
+            conn.execute("DELETE FROM fragments WHERE stored_at < ?", (time.time() - FRAGMENT_SHARED_TTL,))
+        conn.commit()
+
+class FragmentCache:
+    def __init__(self, shared=None):
+        self.local = MemoryFragmentCache()
+        self.shared = shared
+
+    def get(self, key):
+        html = self.local.get(key)
+        if html is None and self.shared is not None:
+            try:
+                html = self.shared.get(key)
+            except sqlite3.Error:
+                html = None
+            if html is not None:
+                self.local.set(key, html)
+        return html
+
+    def set(self, key, html):
+        self.local.set(key, html)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, html)
+            except sqlite3.Error as e:
+                print("fragment cache write failed:", e)
+
+fragment_cache = FragmentCache(SqliteFragmentCache() if FRAGMENT_CACHE_BACKEND == "sqlite" else None)
+
+def fragment_key(*parts):
+    """Stable string key; long/free-text parts are hashed."""
+    return hashlib.md5("\x1f".join("" if p is None else str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def cached_fragment(key, render):
+    """Return cached Markup for key, calling render() (-> str) on a miss."""
+    html = fragment_cache.get(key)
+    if html is None:
+        html = str(render())
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+def bump_post_version(db, post_id):
+    """Invalidate cached cards for post_id. No commit."""
+    db.execute("UPDATE posts SET version = version + 1 WHERE id = ?", (post_id,))
+
+# ---------- Page validators (weak ETag / 304) ----------
+# /home and /profile answer If-None-Match from a couple of indexed lookups
+# (max post id + the feed_versions counters) before running any feed query.
+# PAGE_BUILD_TAG folds in the templates and static fingerprints so a deploy
+# never revalidates against the old markup.
+def _page_build_tag():
+    parts = [str(os.path.getmtime(os.path.abspath(__file__)))]
+    tdir = os.path.join(BASE_DIR, "templates")
+    for name in sorted(os.listdir(tdir)):
+        parts.append(f"{name}:{os.stat(os.path.join(tdir, name)).st_mtime_ns}")
+    parts.extend(f"{k}:{v[2]}" for k, v in sorted(_asset_manifest.items()))
+    return fragment_key(*parts)
+
+PAGE_BUILD_TAG = _page_build_tag()
+
+def page_etag(*parts):
+    return fragment_key(PAGE_BUILD_TAG, session.get("user_rev"), *parts)
+
+def feed_state(user_id, own_posts=False):
+    """(max post id, feed version, user's version) for building a page ETag."""
+    max_sql = ("SELECT MAX(id) FROM posts WHERE user_id = :uid" if own_posts
+               else "SELECT MAX(id) FROM posts")
+    row = get_db().execute(f"""
+        SELECT ({max_sql}),
+               (SELECT version FROM feed_versions WHERE scope = 0),
+               (SELECT version FROM feed_versions WHERE scope = :uid)
+    """, {"uid": user_id}).fetchone()
+    return tuple(row)
+
+def not_modified(etag):
+    """A 304 if the client already holds this page, else None."""
+    if session.get("_flashes"):
+        return None  # the page has to show (and so consume) them
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        return with_page_etag(response, etag)
+    return None
+
+def with_page_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    # per-viewer pages: browser may keep them, but must ask every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# ---------- Preload hints (Link: rel=preload) ----------
+# The first screen of /home needs the top few post images and their authors'
+# avatars; the browser would only find them after parsing the shell. They
+# go out as Link headers, which (with the feed streamed) reach the browser
+# before the feed query runs. WSGI can't send a 103 itself, so Early Hints
+# come from the edge: proxies/CDNs that turn Link preloads into 103s.
+HOME_PRELOAD_POSTS = 3
+PRELOAD_IMAGE_EXT = {"png", "jpg", "jpeg", "gif", "webp"}
+
+def feed_preload_urls(user_id, limit=HOME_PRELOAD_POSTS):
+    """[(url, as)] for the media at the top of user_id's feed."""
+    db = get_db()
+    blocked = get_social_graph(user_id)[1]
+    rows = db.execute("""
+        SELECT posts.id, posts.user_id, posts.media_filename, users.avatar_filename,
+               (SELECT filename FROM post_media WHERE post_id = posts.id ORDER BY ord LIMIT 1) AS first_file,
+               (SELECT poster FROM post_media WHERE post_id = posts.id ORDER BY ord LIMIT 1) AS first_poster
+        FROM posts
+        JOIN users ON posts.user_id = users.id
+        WHERE posts.deleted_at IS NULL
+        ORDER BY posts.id DESC
+        LIMIT ?
+    """, (limit + len(blocked),)).fetchall()
+    urls = []
+    for r in [r for r in rows if r["user_id"] not in blocked][:limit]:
+        if r["avatar_filename"]:
+            urls.append((url_for("uploaded_file", filename=r["avatar_filename"]), "image"))
+        fname = r["first_file"] or r["media_filename"]
+        # images and video posters only: a video preload would pull the whole file
+        if r["first_poster"]:
+            urls.append((url_for("uploaded_file", filename=r["first_poster"]), "image"))
+        elif fname and fname.rsplit(".", 1)[-1].lower() in PRELOAD_IMAGE_EXT:
+            urls.append((url_for("uploaded_file", filename=fname), "image"))
+    return list(dict.fromkeys(urls))
+
+def add_preload_links(response, urls):
+    if urls:
+        response.headers["Link"] = ", ".join(f"<{u}>; rel=preload; as={kind}" for u, kind in urls)
+    return response
 
 
 # ---------- Routes ----------
@@ -626,6 +2516,75 @@ def index():
         return redirect(url_for("home"))
     return redirect(url_for("login"))
 
+# ---------- Password hashing (bounded executor) ----------
+# scrypt/pbkdf2 release the GIL, so a small pool caps how many cores password
+# work can take from the request threads. Past PASSWORD_MAX_PENDING queued
+# jobs, logins are turned away with a 503 instead of piling up.
+# KIDSTA_PASSWORD_METHOD takes any werkzeug method spec ("scrypt:32768:8:1",
+# "pbkdf2:sha256:600000", ...); hashes made with other parameters are
+# upgraded the next time their owner logs in.
+PASSWORD_HASH_METHOD = os.environ.get("KIDSTA_PASSWORD_METHOD", "scrypt:32768:8:1")
+PASSWORD_HASH_WORKERS = int(os.environ.get("KIDSTA_PASSWORD_WORKERS", "2"))
+PASSWORD_MAX_PENDING = int(os.environ.get("KIDSTA_PASSWORD_MAX_PENDING", "32"))
+PASSWORD_WAIT_SECONDS = 10
+
+# werkzeug normalises the spec ("scrypt" -> "scrypt:32768:8:1"); this also
+# fails fast at startup on a bad KIDSTA_PASSWORD_METHOD
+PASSWORD_METHOD_TAG = generate_password_hash("probe", method=PASSWORD_HASH_METHOD).split("$", 1)[0]
+
+_password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="kidsta-pw")
+_password_slots = threading.BoundedSemaphore(PASSWORD_MAX_PENDING)
+
+class PasswordBusy(Exception):
+    """Too many password operations already queued on this worker."""
+
+def _submit_password_job(fn, *args):
+    if not _password_slots.acquire(blocking=False):
+        raise PasswordBusy()
+    try:
+        fut = _password_pool.submit(fn, *args)
+    except Exception:
+        _password_slots.release()
+        raise
+    fut.add_done_callback(lambda f: _password_slots.release())
+    return fut
+
+def _run_password_job(fn, *args):
+    try:
+        return _submit_password_job(fn, *args).result(timeout=PASSWORD_WAIT_SECONDS)
+    except FutureTimeout:
+        raise PasswordBusy()
+
+def hash_password(password):
+    return _run_password_job(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(pw_hash, password):
+    return _run_password_job(check_password_hash, pw_hash, password)
+
+def password_needs_rehash(pw_hash):
+    return not pw_hash or pw_hash.split("$", 1)[0] != PASSWORD_METHOD_TAG
+
+def _rehash_password(user_id, old_hash, password):
+    new_hash = generate_password_hash(password, PASSWORD_HASH_METHOD)
+    conn = _gc_connect()
+    try:
+        # only if nobody changed it meanwhile
+        conn.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?", (new_hash, user_id, old_hash))
+        conn.commit()
+    finally:
+        conn.close()
+
+def schedule_password_rehash(user_id, old_hash, password):
+    """Upgrade a hash in the background; skipped (retried next login) when busy."""
+    try:
+        _submit_password_job(_rehash_password, user_id, old_hash, password)
+    except PasswordBusy:
+        pass
+
+def _login_busy():
+    flash("Lots of kids are logging in right now. Please try again in a moment.", "info")
+    return render_template("login.html"), 503, {"Retry-After": "2"}
+
 # ---------- LOGIN (create or login) ----------
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -653,9 +2612,15 @@ def login():
         user = db.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
 
         if user:
-            if not check_password_hash(user["password"], password):
+            try:
+                ok = verify_password(user["password"], password)
+            except PasswordBusy:
+                return _login_busy()
+            if not ok:
                 flash("Wrong password.", "danger")
                 return redirect(url_for("login"))
+            if password_needs_rehash(user["password"]):
+                schedule_password_rehash(user["id"], user["password"], password)
 
             session["user_id"] = user["id"]
             session["display_name"] = user["display_name"]
@@ -667,7 +2632,10 @@ def login():
                 return redirect(url_for("home"))
             return redirect(url_for("profile_setup"))
         else:
-            pw_hash = generate_password_hash(password)
+            try:
+                pw_hash = hash_password(password)
+            except PasswordBusy:
+                return _login_busy()
             created_at = datetime.utcnow().isoformat()
             cur = db.cursor()
             cur.execute("INSERT INTO users (username, password, age, created_at) VALUES (?, ?, ?, ?)",
@@ -697,7 +2665,7 @@ def audio_library():
 @app.route("/audio/<path:filename>")
 def uploaded_audio(filename):
     folder = os.path.join("static", "audio_library")
-    return send_from_directory(folder, filename)
+    return apply_asset_caching(send_from_directory(folder, filename), "audio_library/" + filename)
 
 # ---------- LOGOUT ----------
 @app.route("/logout")
@@ -715,7 +2683,14 @@ def reels():
     user = get_current_user()
     if not user:
         return redirect(url_for("login"))
-    return render_template("reels.html", user=user)
+    # fingerprinted preview URLs for the song picker (see audioUrl() in the page)
+    folder = os.path.join(BASE_DIR, "static", "audio_library")
+    try:
+        songs = [f for f in os.listdir(folder) if f.lower().endswith((".mp3", ".wav", ".m4a", ".ogg"))]
+    except OSError:
+        songs = []
+    audio_urls = {f: url_for("uploaded_audio", filename=f) for f in songs}
+    return render_template("reels.html", user=user, audio_urls=audio_urls)
 
 # ---------- PROFILE SETUP ----------
 @app.route("/profile_setup", methods=["GET", "POST"])
@@ -751,12 +2726,13 @@ def profile_setup():
                 return redirect(url_for("profile_setup"))
             fname = secure_filename(file.filename)
             stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            avatar_fname = f"{stamp}_{fname}"
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], avatar_fname))
+            avatar_fname, avatar_path = new_upload_path(f"{stamp}_{fname}")
+            file.save(avatar_path)
 
         db.execute("UPDATE users SET display_name = ?, kidsta_id = ?, avatar_filename = ? WHERE id = ?",
                    (display_name, kidsta_id, avatar_fname, user["id"]))
         db.commit()
+        invalidate_current_user(user["id"])
 
         session["display_name"] = display_name
         session["avatar_filename"] = avatar_fname
@@ -777,10 +2753,27 @@ def profile():
         flash("Please login first.", "danger")
         return redirect(url_for("login"))
 
+    etag = page_etag("profile", user["id"], *feed_state(user["id"], own_posts=True))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
     db = get_db()
-    posts = db.execute("SELECT * FROM posts WHERE user_id = ? ORDER BY created_at DESC", (user["id"],)).fetchall()
-    pending = db.execute("SELECT COUNT(*) AS c FROM friends WHERE friend_id = ? AND status = 'pending'", (user["id"],)).fetchone()["c"]
-    return render_template("profile.html", user=user, posts=posts, pending_requests=pending)
+    rows = db.execute("""
+        SELECT posts.*,
+               (SELECT poster FROM post_media WHERE post_id = posts.id ORDER BY ord LIMIT 1) AS poster
+        FROM posts WHERE user_id = ? AND deleted_at IS NULL ORDER BY created_at DESC
+    """, (user["id"],)).fetchall()
+    # owner view (edit/delete controls); everything else on the card is the post's own
+    posts = [{
+        "id": r["id"],
+        "html": cached_fragment(fragment_key("profile", r["id"], r["version"], "owner"),
+                                lambda r=r: render_template("post_card_profile.html", p=r)),
+    } for r in rows]
+    pending = db.execute("SELECT COUNT(*) AS c FROM friend_requests WHERE to_id = ? AND status = 'pending'", (user["id"],)).fetchone()["c"]
+    html = render_template("profile.html", user=user, posts=posts, pending_requests=pending,
+                           flashes=get_flashed_messages(with_categories=True))
+    return with_page_etag(app.make_response(html), etag)
 
 # --- Safe helper functions for counts (add if not present) ---
 def get_like_count(post_id):
@@ -812,7 +2805,7 @@ def get_dislike_count(post_id):
 def get_comment_count(post_id):
     try:
         cur = get_db().cursor()
-        cur.execute("SELECT COUNT(*) AS c FROM comments WHERE post_id = ?", (post_id,))
+        cur.execute("SELECT comment_count AS c FROM posts WHERE id = ?", (post_id,))
         row = cur.fetchone()
         return row["c"] if row else 0
     except Exception:
@@ -842,8 +2835,7 @@ def upload_post():
 
             fname = secure_filename(f.filename)
             stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            final_fname = f"{stamp}_{fname}"
-            final_path = os.path.join(app.config["UPLOAD_FOLDER"], final_fname)
+            final_fname, final_path = new_upload_path(f"{stamp}_{fname}")
 
             try:
                 f.save(final_path)
@@ -867,7 +2859,8 @@ def upload_post():
             else:
                 mtype = "other"
 
-            saved_files.append((final_fname, mtype))
+            # metadata (Pillow/ffmpeg) now, before the post INSERT opens the transaction
+            saved_files.append((final_fname, mtype, media_metadata(final_fname, mtype)))
 
         created_at = datetime.utcnow().isoformat()
         db = get_db()
@@ -886,12 +2879,9 @@ def upload_post():
         post_id = cur.lastrowid
 
         ord_idx = 0
-        for fname, mtype in saved_files:
+        for fname, mtype, meta in saved_files:
             ord_idx += 1
-            db.execute(
-                "INSERT INTO post_media (post_id, filename, media_type, ord, created_at) VALUES (?, ?, ?, ?, ?)",
-                (post_id, fname, mtype, ord_idx, created_at)
-            )
+            add_post_media(db, post_id, fname, mtype, ord_idx, created_at, meta)
 
         db.commit()
         flash("Post uploaded to your friends!", "success")
@@ -927,8 +2917,7 @@ def upload_reel():
         print("UPLOAD_REEL: save error:", e)
         return jsonify({"ok": False, "message": "Save failed"}), 500
 
-    final_name = f"reel_{stamp}_{safe_name(orig_fname)}"
-    final_path = os.path.join(app.config["UPLOAD_FOLDER"], final_name)
+    final_name, final_path = new_upload_path(f"reel_{stamp}_{safe_name(orig_fname)}")
 
     if song:
         song_safe = safe_name(song)
@@ -953,6 +2942,7 @@ def upload_reel():
                 "-b:a", "192k",
                 "-shortest",
                 "-t", "60",
+                "-movflags", "+faststart",
                 merged_tmp
             ]
             proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -971,6 +2961,7 @@ def upload_reel():
                     "-b:a", "192k",
                     "-shortest",
                     "-t", "60",
+                    "-movflags", "+faststart",
                     merged_tmp
                 ]
                 proc2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -995,21 +2986,113 @@ def upload_reel():
     caption = "Reel"
     if song:
         caption += f" · Song: {song}"
+    meta = media_metadata(final_name, "video")  # ffmpeg; keep it out of the write transaction
     created_at = datetime.utcnow().isoformat()
     db = get_db()
     try:
-        db.execute(
+        cur = db.execute(
             "INSERT INTO posts (user_id, caption, media_filename, created_at, visibility) VALUES (?, ?, ?, ?, ?)",
             (user["id"], caption, final_name, created_at, "public")
         )
     except Exception:
-        db.execute(
+        cur = db.execute(
             "INSERT INTO posts (user_id, caption, media_filename, created_at) VALUES (?, ?, ?, ?)",
             (user["id"], caption, final_name, created_at)
         )
+    add_post_media(db, cur.lastrowid, final_name, "video", 1, created_at, meta)
     db.commit()
     return jsonify({"ok": True, "redirect": url_for("home")})
 
+# ---------- REELS playback feed ----------
+# /reels/watch is a vertical, one-reel-per-screen player fed by /api/reels
+# (keyset-paginated on post id, newest first). Each reel carries
+# prefetch_bytes: the header plus roughly REELS_PREFETCH_SECONDS of media,
+# which the player range-requests for the next REELS_PREFETCH_AHEAD reels
+# only. It is null when the moov box isn't up front (the browser would need
+# the file's tail first), and the player then just preloads metadata.
+REELS_PAGE_SIZE = 10
+REELS_MAX_PAGE_SIZE = 30
+REELS_PREFETCH_AHEAD = 2
+REELS_PREFETCH_SECONDS = 3
+REELS_PREFETCH_FALLBACK = 512 * 1024  # when the duration is unknown
+
+def reel_prefetch_bytes(r):
+    if r["header_bytes"] is None or not r["bytes"]:
+        return None
+    if r["duration"]:
+        rate = (r["bytes"] - r["header_bytes"]) / r["duration"]
+        want = r["header_bytes"] + int(rate * REELS_PREFETCH_SECONDS)
+    else:
+        want = r["header_bytes"] + REELS_PREFETCH_FALLBACK
+    return min(want, r["bytes"])
+
+def fetch_reels(viewer_id, before=None, limit=REELS_PAGE_SIZE):
+    """Video posts newest first (post id < before), minus blocked authors."""
+    blocked = sorted(get_social_graph(viewer_id)[1])
+    params = [before or 2**63 - 1] + blocked + [limit]
+    return get_db().execute(f"""
+        SELECT p.id, p.caption, p.created_at, p.user_id, p.comment_count,
+               u.display_name, u.kidsta_id, u.avatar_filename,
+               pm.filename, pm.poster, pm.width, pm.height, pm.placeholder,
+               pm.duration, pm.bytes, pm.header_bytes
+        FROM posts p
+        JOIN post_media pm ON pm.post_id = p.id
+            AND pm.ord = (SELECT MIN(ord) FROM post_media WHERE post_id = p.id)
+        JOIN users u ON u.id = p.user_id
+        WHERE p.deleted_at IS NULL AND pm.media_type = 'video' AND p.id < ?
+          AND p.user_id NOT IN ({", ".join("?" * len(blocked))})
+        ORDER BY p.id DESC
+        LIMIT ?
+    """, params).fetchall()
+
+def reel_json(r):
+    likes, dislikes = get_vote_counts(r["id"])
+    return {
+        "id": r["id"],
+        "video": url_for("uploaded_file", filename=r["filename"]),
+        "poster": url_for("uploaded_file", filename=r["poster"]) if r["poster"] else None,
+        "width": r["width"],
+        "height": r["height"],
+        "placeholder": r["placeholder"],
+        "duration": r["duration"],
+        "bytes": r["bytes"],
+        "prefetch_bytes": reel_prefetch_bytes(r),
+        "caption": r["caption"],
+        "created_at": r["created_at"],
+        "author": {
+            "id": r["user_id"],
+            "display_name": r["display_name"] or r["kidsta_id"],
+            "avatar": url_for("uploaded_file", filename=r["avatar_filename"]) if r["avatar_filename"] else None,
+        },
+        "likes": likes,
+        "dislikes": dislikes,
+        "comments": r["comment_count"],
+    }
+
+@app.route("/api/reels")
+def api_reels():
+    init_db()
+    user = get_current_user()
+    if not user:
+        return jsonify({"ok": False, "message": "Not logged in"}), 401
+    before = request.args.get("before", type=int)
+    limit = max(1, min(request.args.get("limit", REELS_PAGE_SIZE, type=int), REELS_MAX_PAGE_SIZE))
+    rows = fetch_reels(user["id"], before, limit)
+    return jsonify({
+        "ok": True,
+        "reels": [reel_json(r) for r in rows],
+        "next_before": rows[-1]["id"] if len(rows) == limit else None,
+        "prefetch_ahead": REELS_PREFETCH_AHEAD,
+    })
+
+@app.route("/reels/watch")
+def watch_reels():
+    init_db()
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("login"))
+    return render_template("reels_watch.html", user=user)
+
 # ---------- DELETE post (owner only) ----------
 @app.route("/delete_post/<int:post_id>", methods=["POST"])
 def delete_post(post_id):
@@ -1019,7 +3102,7 @@ def delete_post(post_id):
         return redirect(url_for("login"))
 
     db = get_db()
-    post = db.execute("SELECT * FROM posts WHERE id = ?", (post_id,)).fetchone()
+    post = db.execute("SELECT * FROM posts WHERE id = ? AND deleted_at IS NULL", (post_id,)).fetchone()
     if not post:
         flash("Post not found.", "danger")
         return redirect(url_for("home"))
@@ -1027,26 +3110,10 @@ def delete_post(post_id):
         flash("Not allowed.", "danger")
         return redirect(url_for("home"))
 
-    # remove main file
-    if post["media_filename"]:
-        try:
-            os.remove(os.path.join(app.config["UPLOAD_FOLDER"], post["media_filename"]))
-        except Exception:
-            pass
-
-    # remove all post_media files and entries
-    media_rows = db.execute("SELECT filename FROM post_media WHERE post_id = ?", (post_id,)).fetchall()
-    for m in media_rows:
-        try:
-            os.remove(os.path.join(app.config["UPLOAD_FOLDER"], m["filename"]))
-        except Exception:
-            pass
-    db.execute("DELETE FROM post_media WHERE post_id = ?", (post_id,))
-
-    db.execute("DELETE FROM posts WHERE id = ?", (post_id,))
-    db.execute("DELETE FROM likes WHERE post_id = ?", (post_id,))
-    db.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
+    # tombstone only; rows and files are cleaned up by the background collector
+    db.execute("UPDATE posts SET deleted_at = ? WHERE id = ?", (datetime.utcnow().isoformat(), post_id))
     db.commit()
+    enqueue_post_purge(post_id)
     flash("Post deleted.", "info")
     return redirect(url_for("profile"))
 
@@ -1059,7 +3126,7 @@ def edit_post(post_id):
         return redirect(url_for("login"))
 
     db = get_db()
-    post = db.execute("SELECT * FROM posts WHERE id = ?", (post_id,)).fetchone()
+    post = db.execute("SELECT * FROM posts WHERE id = ? AND deleted_at IS NULL", (post_id,)).fetchone()
     if not post:
         flash("Post not found.", "danger")
         return redirect(url_for("profile"))
@@ -1078,17 +3145,18 @@ def edit_post(post_id):
                 return redirect(url_for("edit_post", post_id=post_id))
             try:
                 if post["media_filename"]:
-                    old = os.path.join(app.config["UPLOAD_FOLDER"], post["media_filename"])
+                    old = os.path.join(app.config["UPLOAD_FOLDER"], resolve_upload_name(post["media_filename"]))
                     if os.path.exists(old):
                         os.remove(old)
             except Exception:
                 pass
             fname = secure_filename(file.filename)
             stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            media_fname = f"{stamp}_{fname}"
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], media_fname))
+            media_fname, media_path = new_upload_path(f"{stamp}_{fname}")
+            file.save(media_path)
 
         db.execute("UPDATE posts SET caption = ?, media_filename = ? WHERE id = ?", (caption, media_fname, post_id))
+        bump_post_version(db, post_id)
         db.commit()
         flash("Post updated.", "success")
         return redirect(url_for("profile"))
@@ -1096,52 +3164,147 @@ def edit_post(post_id):
     return render_template("edit_post.html", post=post)
 
 # ---------- LIKE / DISLIKE toggle ----------
-@app.route("/like/<int:post_id>", methods=["POST"])
-def like_post(post_id):
-    init_db()
-    user = get_current_user()
-    if not user:
-        flash("Please login first.", "danger")
-        return redirect(url_for("login"))
+def get_vote_counts(post_id):
+    row = get_db().execute("""
+        SELECT COALESCE(SUM(value = 1), 0) AS likes, COALESCE(SUM(value = -1), 0) AS dislikes
+        FROM likes WHERE post_id = ?
+    """, (post_id,)).fetchone()
+    return row["likes"], row["dislikes"]
+
+def toggle_like(user_id, post_id, value):
+    """
+    Apply a like (1) / dislike (-1) click: pressing the current vote again
+    removes it, otherwise it is upserted. One write either way (the DELETE
+    only matches when it's a repeat). Returns the user's vote afterwards
+    (1, -1, 0), or None if the post doesn't exist.
+    """
+    db = get_db()
+    cur = db.execute("DELETE FROM likes WHERE user_id = ? AND post_id = ? AND value = ?", (user_id, post_id, value))
+    if cur.rowcount:
+        bump_post_version(db, post_id)
+        db.commit()
+        return 0
+
+    cur = db.execute("""
+        INSERT INTO likes (user_id, post_id, value, created_at)
+        SELECT ?, id, ?, ? FROM posts WHERE id = ? AND deleted_at IS NULL
+        ON CONFLICT (user_id, post_id) DO UPDATE SET value = excluded.value, created_at = excluded.created_at
+    """, (user_id, value, datetime.utcnow().isoformat(), post_id))
+    if not cur.rowcount:
+        db.commit()
+        return None
+    bump_post_version(db, post_id)
+    db.commit()
+
+    if value == 1:
+        post = db.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,)).fetchone()
+        if post and post["user_id"] != user_id:
+            create_notification(post["user_id"], "like", from_user_id=user_id, post_id=post_id)
+    return value
 
+def _vote_value():
     try:
         value = int(request.form.get("value", "1"))
         if value not in (1, -1):
             value = 1
     except:
         value = 1
+    return value
 
-    db = get_db()
+@app.route("/like/<int:post_id>", methods=["POST"])
+def like_post(post_id):
+    # no-JS fallback for the forms in home.html; the page itself uses /api/like
+    init_db()
+    user = get_current_user()
+    if not user:
+        flash("Please login first.", "danger")
+        return redirect(url_for("login"))
 
-    post = db.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,)).fetchone()
-    post_owner_id = post["user_id"] if post else None
+    if toggle_like(user["id"], post_id, _vote_value()) is not None:
+        publish_post_counts(post_id)
+    return redirect(request.referrer or url_for("home"))
 
-    existing = db.execute("SELECT * FROM likes WHERE user_id = ? AND post_id = ?", (user["id"], post_id)).fetchone()
+@app.route("/api/like/<int:post_id>", methods=["POST"])
+def api_like(post_id):
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"ok": False, "error": "login needed"}), 401
 
-    if not existing:
-        db.execute("INSERT INTO likes (user_id, post_id, value, created_at) VALUES (?, ?, ?, ?)",
-                   (user["id"], post_id, value, datetime.utcnow().isoformat()))
-        if value == 1 and post_owner_id and post_owner_id != user["id"]:
-            create_notification(post_owner_id, "like", from_user_id=user["id"], post_id=post_id)
-    else:
-        if existing["value"] == value:
-            db.execute("DELETE FROM likes WHERE id = ?", (existing["id"],))
-        else:
-            db.execute("UPDATE likes SET value = ?, created_at = ? WHERE id = ?",
-                       (value, datetime.utcnow().isoformat(), existing["id"]))
-            if value == 1 and post_owner_id and post_owner_id != user["id"]:
-                create_notification(post_owner_id, "like", from_user_id=user["id"], post_id=post_id)
+    vote = toggle_like(uid, post_id, _vote_value())
+    if vote is None:
+        return jsonify({"ok": False, "error": "post not found"}), 404
+    likes, dislikes = get_vote_counts(post_id)
+    publish_post_counts(post_id, likes=likes, dislikes=dislikes)
+    return jsonify({"ok": True, "post_id": post_id, "vote": vote, "likes": likes, "dislikes": dislikes})
 
+# ---------- COMMENTS page + add comment ----------
+# Threads load newest page first (shown oldest-to-newest) with a keyset
+# cursor on comments.id; "Load earlier" pulls older pages as JSON. Rendered
+# pages are cached per worker under (post, comment_version, cursor), so a
+# new or deleted comment (which bumps the version) retires them.
+COMMENTS_PAGE_SIZE = 30
+COMMENT_CACHE_MAX = 500
+COMMENT_CACHE_TTL = 60  # seconds; bounds staleness of display names
+
+_comment_cache = OrderedDict()  # (post_id, version, before) -> (cached_at, html, next_before)
+_comment_cache_lock = threading.Lock()
+
+def fetch_comment_page(post_id, before=None, limit=COMMENTS_PAGE_SIZE):
+    """Comments older than `before` (newest page if None), oldest first, plus the next cursor."""
+    rows = get_db().execute("""
+        SELECT c.id, c.text, c.created_at, u.display_name
+        FROM comments c JOIN users u ON c.user_id = u.id
+        WHERE c.post_id = ? AND c.id < ?
+        ORDER BY c.id DESC
+        LIMIT ?
+    """, (post_id, before or 2 ** 63 - 1, limit + 1)).fetchall()
+    next_before = rows[limit - 1]["id"] if len(rows) > limit else None
+    return list(reversed(rows[:limit])), next_before
+
+def render_comment_page(post_id, version, before=None):
+    """(html, next_before) for one page of the thread, cached by comment version."""
+    key = (post_id, version, before)
+    now = time.time()
+    with _comment_cache_lock:
+        hit = _comment_cache.get(key)
+        if hit and now - hit[0] < COMMENT_CACHE_TTL:
+            _comment_cache.move_to_end(key)
+            return hit[1], hit[2]
+
+    rows, next_before = fetch_comment_page(post_id, before)
+    html = Markup(render_template("comment_items.html", comments=rows))
+    with _comment_cache_lock:
+        _comment_cache[key] = (now, html, next_before)
+        _comment_cache.move_to_end(key)
+        while len(_comment_cache) > COMMENT_CACHE_MAX:
+            _comment_cache.popitem(last=False)
+    return html, next_before
+
+def add_comment(user, post, text):
+    """Insert a comment and fan out the notification/counters. Returns the new row."""
+    db = get_db()
+    now = datetime.utcnow().isoformat()
+    cur = db.execute("INSERT INTO comments (user_id, post_id, text, created_at) VALUES (?, ?, ?, ?)",
+                     (user["id"], post["id"], text, now))
+    bump_post_version(db, post["id"])
     db.commit()
-    return redirect(request.referrer or url_for("home"))
+    publish_post_counts(post["id"])
+
+    if post["user_id"] != user["id"]:
+        create_notification(post["user_id"], "comment", from_user_id=user["id"], post_id=post["id"])
+    return {"id": cur.lastrowid, "text": text, "created_at": now, "display_name": user["display_name"]}
+
+def _live_post(post_id):
+    return get_db().execute("""
+        SELECT p.*, u.display_name FROM posts p JOIN users u ON p.user_id = u.id
+        WHERE p.id = ? AND p.deleted_at IS NULL
+    """, (post_id,)).fetchone()
 
-# ---------- COMMENTS page + add comment ----------
 @app.route("/post/<int:post_id>/comments", methods=["GET", "POST"])
 def post_comments(post_id):
     init_db()
     user = get_current_user()
-    db = get_db()
-    post = db.execute("SELECT p.*, u.display_name FROM posts p JOIN users u ON p.user_id = u.id WHERE p.id = ?", (post_id,)).fetchone()
+    post = _live_post(post_id)
     if not post:
         flash("Post not found.", "danger")
         return redirect(url_for("home"))
@@ -1155,20 +3318,46 @@ def post_comments(post_id):
             flash("Please write a comment.", "danger")
             return redirect(url_for("post_comments", post_id=post_id))
 
-        db.execute("INSERT INTO comments (user_id, post_id, text, created_at) VALUES (?, ?, ?, ?)",
-                   (user["id"], post_id, text, datetime.utcnow().isoformat()))
-        db.commit()
-
-        if post["user_id"] != user["id"]:
-            create_notification(post["user_id"], "comment", from_user_id=user["id"], post_id=post_id)
-
+        add_comment(user, post, text)
         flash("Comment added.", "success")
         return redirect(url_for("post_comments", post_id=post_id))
 
-    comments = db.execute("SELECT c.*, u.display_name FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC", (post_id,)).fetchall()
-    likes_count = db.execute("SELECT COUNT(*) AS c FROM likes WHERE post_id = ? AND value = 1", (post_id,)).fetchone()["c"]
-    dislikes_count = db.execute("SELECT COUNT(*) AS c FROM likes WHERE post_id = ? AND value = -1", (post_id,)).fetchone()["c"]
-    return render_template("comments.html", post=post, comments=comments, likes=likes_count, dislikes=dislikes_count, user=user)
+    thread_html, next_before = render_comment_page(post_id, post["comment_version"])
+    likes_count, dislikes_count = get_vote_counts(post_id)
+    return render_template("comments.html", post=post, thread_html=thread_html, next_before=next_before,
+                           comment_count=post["comment_count"], likes=likes_count, dislikes=dislikes_count, user=user)
+
+@app.route("/api/post/<int:post_id>/comments")
+def api_comment_page(post_id):
+    """Older comments for "Load earlier": ?before=<comment id> -> {html, next_before}."""
+    init_db()
+    post = get_db().execute("SELECT comment_version FROM posts WHERE id = ? AND deleted_at IS NULL", (post_id,)).fetchone()
+    if not post:
+        return jsonify({"ok": False, "error": "post not found"}), 404
+    try:
+        before = int(request.args.get("before", "")) or None
+    except ValueError:
+        before = None
+    html, next_before = render_comment_page(post_id, post["comment_version"], before)
+    return jsonify({"ok": True, "html": str(html), "next_before": next_before})
+
+@app.route("/api/post/<int:post_id>/comments", methods=["POST"])
+def api_add_comment(post_id):
+    """Append a comment; returns just its rendered fragment."""
+    init_db()
+    user = get_current_user()
+    if not user:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    post = _live_post(post_id)
+    if not post:
+        return jsonify({"ok": False, "error": "post not found"}), 404
+    text = request.form.get("text", "").strip()
+    if not text:
+        return jsonify({"ok": False, "error": "Please write a comment."}), 400
+
+    row = add_comment(user, post, text)
+    return jsonify({"ok": True, "html": render_template("comment_items.html", comments=[row]),
+                    "comments": get_comment_count(post_id)})
 
 # ---------- HOME feed ----------
 @app.route("/home")
@@ -1181,37 +3370,23 @@ def home():
     user_id = session["user_id"]
 
     # 2. Get logged-in user info
-    cur = get_db().cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cur.fetchone()
+    user = get_current_user()
     if not user:
         return redirect("/login")
 
-    # 3. Fetch all posts (with user info + avatar)
-    cur.execute("""
-        SELECT 
-            posts.id AS post_id,
-            posts.caption,
-            posts.user_id,
-            posts.media_filename AS legacy_media,
-            posts.created_at,
-            users.display_name,
-            users.kidsta_id,
-            users.avatar_filename AS avatar_filename
-        FROM posts
-        JOIN users ON posts.user_id = users.id
-        ORDER BY posts.id DESC
-    """)
-    rows = cur.fetchall()
-
-    posts_with_meta = []
+    q = (request.args.get("q") or "").strip().lower()
+    etag = page_etag("home", user_id, q, *feed_state(user_id))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
 
-    for r in rows:
+    def render_card(r):
         # load media rows preferring post_media table (new schema)
         media_rows = []
         try:
+            cur = get_db().cursor()
             cur.execute("""
-                SELECT filename, media_type
+                SELECT filename, media_type, width, height, placeholder, poster
                 FROM post_media
                 WHERE post_id = ?
                 ORDER BY ord ASC
@@ -1246,34 +3421,78 @@ def home():
             "kidsta_id": r["kidsta_id"],
             "avatar": r["avatar_filename"]  # may be None
         }
+        likes, dislikes = get_vote_counts(r["post_id"])
 
-        posts_with_meta.append({
+        return render_template("post_card_home.html", item={
             "post": post_obj,
             "media": media_rows,
-            "likes": get_like_count(r["post_id"]),
-            "dislikes": get_dislike_count(r["post_id"]),
-            "comments": get_comment_count(r["post_id"])
+            "likes": likes,
+            "dislikes": dislikes,
+            "comments": r["comment_count"]
         })
 
-    # 4. SEARCH FILTER (if q provided)
-    q = (request.args.get("q") or "").strip().lower()
-    if q:
-        filtered_posts = []
-        for item in posts_with_meta:
-            p = item["post"]
-            cap = (p.get("caption") or "").lower() if isinstance(p, dict) else (p["caption"] or "").lower()
-            name = (p.get("display_name") or "").lower() if isinstance(p, dict) else (p["display_name"] or "").lower()
-            kid = (p.get("kidsta_id") or "").lower() if isinstance(p, dict) else (p["kidsta_id"] or "").lower()
-            if q in cap or q in name or q in kid:
-                filtered_posts.append(item)
-        posts_with_meta = filtered_posts
-
-    # 5. Render template
-    return render_template(
+    def feed_cards():
+        # 3. Fetch all posts (with user info + avatar)
+        cur = get_db().cursor()
+        cur.execute("""
+            SELECT 
+                posts.id AS post_id,
+                posts.caption,
+                posts.user_id,
+                posts.media_filename AS legacy_media,
+                posts.created_at,
+                posts.version,
+                posts.comment_count,
+                users.display_name,
+                users.kidsta_id,
+                users.avatar_filename AS avatar_filename
+            FROM posts
+            JOIN users ON posts.user_id = users.id
+            WHERE posts.deleted_at IS NULL
+            ORDER BY posts.id DESC
+        """)
+        rows = cur.fetchall()
+
+        # drop posts from anyone blocked with the viewer (one set lookup per row)
+        blocked = get_social_graph(user_id)[1]
+        rows = [r for r in rows if r["user_id"] not in blocked]
+
+        # 4. SEARCH FILTER (if q provided)
+        if q:
+            rows = [r for r in rows
+                    if q in (r["caption"] or "").lower()
+                    or q in (r["display_name"] or "").lower()
+                    or q in (r["kidsta_id"] or "").lower()]
+
+        # cards only change with posts.version or the author's name/avatar;
+        # media and counts are only queried for cards that aren't cached
+        for r in rows:
+            yield {
+                "id": r["post_id"],
+                "html": cached_fragment(
+                    fragment_key("home", r["post_id"], r["version"], r["display_name"], r["kidsta_id"], r["avatar_filename"]),
+                    lambda r=r: render_card(r)),
+            }
+
+    # 5. Stream the page: the shell (and its CSS/script URLs) goes out before
+    # the feed query runs, then each card as soon as it is ready
+    # the top of the feed is only predictable without a search filter
+    preload = [(url_for("static", filename="live_events.js"), "script")]
+    if not q:
+        preload += feed_preload_urls(user_id)
+
+    # taken here, not in the template: the session cookie is written before
+    # the streamed body, so a flash consumed while streaming would stick
+    flashes = get_flashed_messages(with_categories=True)
+    response = Response(stream_template(
         "home.html",
-        posts=posts_with_meta,
-        user_id=user_id
-    )
+        posts=feed_cards(),
+        user_id=user_id,
+        flashes=flashes
+    ), mimetype="text/html")
+    response.headers["X-Accel-Buffering"] = "no"
+    add_preload_links(response, preload)
+    return with_page_etag(response, etag)
 
 
 # ---------- REPORT USER ----------
@@ -1303,14 +3522,52 @@ def report_user(reported_id):
 @app.route("/send_friend/<int:from_id>/<int:to_id>", methods=["POST"])
 def send_friend(from_id, to_id):
     init_db()
+    user = get_current_user()
+    if not user:
+        flash("Please login first.", "danger")
+        return redirect(url_for("login"))
+    # the sender is whoever is logged in; the id in the URL only has to agree
+    if from_id != user["id"]:
+        flash("Not allowed.", "danger")
+        return redirect(request.referrer or url_for("search"))
     db = get_db()
-    existing = db.execute("SELECT * FROM friends WHERE user_id = ? AND friend_id = ?", (from_id, to_id)).fetchone()
-    if existing:
-        flash("Friend request already exists.", "info")
+    if from_id == to_id:
+        flash("You can't add yourself.", "info")
         return redirect(request.referrer or url_for("search"))
-    created_at = datetime.utcnow().isoformat()
-    db.execute("INSERT INTO friends (user_id, friend_id, status, created_at) VALUES (?, ?, 'pending', ?)", (from_id, to_id, created_at))
+    if friendship_exists(from_id, to_id):
+        flash("You are already friends.", "info")
+        return redirect(request.referrer or url_for("search"))
+
+    # they already asked us: sending back counts as accepting
+    reverse = db.execute("SELECT id FROM friend_requests WHERE from_id = ? AND to_id = ? AND status = 'pending'",
+                         (to_id, from_id)).fetchone()
+    if reverse:
+        add_friendship(db, from_id, to_id)
+        db.commit()
+        invalidate_social_graph(from_id, to_id)
+        mark_edge_changed(db, from_id, to_id, friendship=True)
+        create_notification(to_id, "friend_accept", from_user_id=from_id)
+        flash("Friend request accepted.", "success")
+        return redirect(request.referrer or url_for("search"))
+
+    if not db.execute("SELECT 1 FROM users WHERE id = ?", (to_id,)).fetchone():
+        flash("User not found.", "danger")
+        return redirect(request.referrer or url_for("search"))
+
+    # one row per direction: a pending request is a no-op and a denied one
+    # stays closed (the sender just sees it as already sent); only a row left
+    # over from a friendship that no longer exists is re-opened
+    cur = db.execute("""
+        INSERT INTO friend_requests (from_id, to_id, status, created_at) VALUES (?, ?, 'pending', ?)
+        ON CONFLICT (from_id, to_id) DO UPDATE SET status = 'pending', created_at = excluded.created_at
+        WHERE friend_requests.status = 'accepted'
+    """, (from_id, to_id, datetime.utcnow().isoformat()))
     db.commit()
+    if cur.rowcount == 0:
+        flash("Friend request already exists.", "info")
+        return redirect(request.referrer or url_for("search"))
+    invalidate_social_graph(from_id, to_id)
+    mark_edge_changed(db, from_id, to_id)
     create_notification(to_id, "friend_request", from_user_id=from_id)
     flash("Friend request sent.", "success")
     return redirect(request.referrer or url_for("search"))
@@ -1322,7 +3579,7 @@ def friend_requests():
     if not user:
         return redirect(url_for("login"))
     db = get_db()
-    reqs = db.execute("SELECT f.id, f.user_id as from_id, u.display_name, u.kidsta_id FROM friends f JOIN users u ON f.user_id = u.id WHERE f.friend_id = ? AND f.status = 'pending'", (user["id"],)).fetchall()
+    reqs = db.execute("SELECT r.id, r.from_id, u.display_name, u.kidsta_id FROM friend_requests r JOIN users u ON r.from_id = u.id WHERE r.to_id = ? AND r.status = 'pending'", (user["id"],)).fetchall()
     return render_template("friend_requests.html", reqs=reqs, user_id=user["id"])
 
 @app.route("/respond_friend/<int:request_id>/<action>", methods=["POST"])
@@ -1332,21 +3589,22 @@ def respond_friend(request_id, action):
     if not user:
         return redirect(url_for("login"))
     db = get_db()
-    rec = db.execute("SELECT * FROM friends WHERE id = ?", (request_id,)).fetchone()
+    rec = db.execute("SELECT * FROM friend_requests WHERE id = ? AND to_id = ?", (request_id, user["id"])).fetchone()
     if not rec:
         flash("Request not found.", "danger")
         return redirect(url_for("friend_requests"))
     if action == "accept":
-        db.execute("UPDATE friends SET status = 'accepted' WHERE id = ?", (request_id,))
-        created_at = datetime.utcnow().isoformat()
-        db.execute("INSERT INTO friends (user_id, friend_id, status, created_at) VALUES (?, ?, 'accepted', ?)",
-                   (rec["friend_id"], rec["user_id"], created_at))
+        add_friendship(db, rec["from_id"], rec["to_id"])
         db.commit()
-        create_notification(rec["user_id"], "friend_accept", from_user_id=user["id"])
+        invalidate_social_graph(rec["from_id"], rec["to_id"])
+        mark_edge_changed(db, rec["from_id"], rec["to_id"], friendship=True)
+        create_notification(rec["from_id"], "friend_accept", from_user_id=user["id"])
         flash("Friend request accepted.", "success")
     else:
-        db.execute("UPDATE friends SET status = 'denied' WHERE id = ?", (request_id,))
+        db.execute("UPDATE friend_requests SET status = 'denied' WHERE id = ?", (request_id,))
         db.commit()
+        invalidate_social_graph(rec["from_id"], rec["to_id"])
+        mark_edge_changed(db, rec["from_id"], rec["to_id"])
         flash("Friend request denied.", "info")
     return redirect(url_for("friend_requests"))
 
@@ -1363,18 +3621,37 @@ def search():
     if q:
         results = db.execute("SELECT id, display_name, kidsta_id, avatar_filename FROM users WHERE kidsta_id LIKE ? LIMIT 10", (f"%{q}%",)).fetchall()
 
-    friend_rows = db.execute("SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted'", (user["id"],)).fetchall()
-    pending_rows = db.execute("SELECT friend_id FROM friends WHERE user_id = ? AND status = 'pending'", (user["id"],)).fetchall()
-    friend_ids = [r["friend_id"] for r in friend_rows]
-    pending_ids = [r["friend_id"] for r in pending_rows]
+    pending_rows = db.execute("SELECT to_id FROM friend_requests WHERE from_id = ? AND status = 'pending'", (user["id"],)).fetchall()
+    friend_ids = list(get_social_graph(user["id"])[0])
+    pending_ids = [r["to_id"] for r in pending_rows]
+
+    visible = set(filter_blocked(user["id"], [r["id"] for r in results]))
+    filtered_results = [r for r in results if r["id"] in visible]
+
+    suggestions = [] if q else get_friend_suggestions(user["id"])
 
-    filtered_results = []
-    for r in results:
-        if is_blocked(user["id"], r["id"]):
-            continue
-        filtered_results.append(r)
+    return render_template("search.html", results=filtered_results, user_id=user["id"], q=q, friend_ids=friend_ids, pending_ids=pending_ids, suggestions=suggestions)
 
-    return render_template("search.html", results=filtered_results, user_id=user["id"], q=q, friend_ids=friend_ids, pending_ids=pending_ids)
+@app.route("/api/suggestions")
+def api_suggestions():
+    init_db()
+    user = get_current_user()
+    if not user:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    try:
+        limit = max(1, min(int(request.args.get("limit", 10)), SUGGEST_PER_USER))
+    except ValueError:
+        limit = 10
+    rows = get_friend_suggestions(user["id"], limit)
+    return jsonify({"ok": True, "suggestions": [
+        {
+            "id": r["id"],
+            "display_name": r["display_name"],
+            "kidsta_id": r["kidsta_id"],
+            "avatar": url_for("uploaded_file", filename=r["avatar_filename"]) if r["avatar_filename"] else None,
+            "mutual": r["mutual_count"],
+        } for r in rows
+    ]})
 
 #@app.route("/make_slideshow", methods=["POST"], endpoint="make_slideshow_secondary")
 def make_slideshow():
@@ -1574,18 +3851,20 @@ def make_slideshow():
         caption = "Photo/Video Slideshow"
         if song:
             caption += f" · Song: {song}"
+        meta = media_metadata(out_name, "video")  # ffmpeg; keep it out of the write transaction
         created_at = datetime.utcnow().isoformat()
         db = get_db()
         try:
-            db.execute(
+            cur = db.execute(
                 "INSERT INTO posts (user_id, caption, media_filename, created_at, visibility) VALUES (?, ?, ?, ?, ?)",
                 (user["id"], caption, out_name, created_at, "public")
             )
         except Exception:
-            db.execute(
+            cur = db.execute(
                 "INSERT INTO posts (user_id, caption, media_filename, created_at) VALUES (?, ?, ?, ?)",
                 (user["id"], caption, out_name, created_at)
             )
+        add_post_media(db, cur.lastrowid, out_name, "video", 1, created_at, meta)
         db.commit()
 
         return jsonify({"ok": True, "video": f"/uploads/{out_name}", "file": out_name})
@@ -1621,34 +3900,99 @@ def api_audio_files():
         files = []
     return jsonify(files)
 
-@app.route("/notifications")
-def notifications():
-    init_db()
-    user = get_current_user()
-    if not user:
-        return redirect(url_for("login"))
+NOTIFICATIONS_PAGE_SIZE = 30
 
-    db = get_db()
-    rows = db.execute("""
+def fetch_notifications(user_id, before=None, limit=NOTIFICATIONS_PAGE_SIZE):
+    """
+    One page of notifications, latest activity first. The keyset cursor is
+    "<updated_at>~<id>" (a rollup that gets new activity moves back to the
+    top). Returns (rows, next_before); next_before is None on the last page.
+    """
+    cursor = ("\uffff", 0)
+    if before and "~" in before:
+        ts, _, nid = before.rpartition("~")
+        if nid.isdigit():
+            cursor = (ts, int(nid))
+    rows = get_db().execute("""
         SELECT n.*, u.display_name AS from_name
         FROM notifications n
         LEFT JOIN users u ON n.from_user_id = u.id
-        WHERE n.user_id = ?
-        ORDER BY n.created_at DESC
-        LIMIT 50
-    """, (user["id"],)).fetchall()
-
+        WHERE n.user_id = ? AND (n.updated_at, n.id) < (?, ?)
+        ORDER BY n.updated_at DESC, n.id DESC
+        LIMIT ?
+    """, (user_id, cursor[0], cursor[1] if before else 2 ** 63 - 1, limit + 1)).fetchall()
+    next_before = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_before = f"{last['updated_at']}~{last['id']}"
+    return rows[:limit], next_before
+
+def mark_notifications_read(user_id, rows):
+    """Mark only the given (displayed) notifications read."""
+    ids = [r["id"] for r in rows if not r["is_read"]]
+    if not ids:
+        return
+    db = get_db()
     try:
-        db.execute("UPDATE notifications SET is_read = 1 WHERE user_id = ?", (user["id"],))
+        db.execute(f"UPDATE notifications SET is_read = 1 WHERE user_id = ? AND id IN ({','.join('?' * len(ids))})",
+                   (user_id, *ids))
         db.commit()
     except Exception:
         pass
 
-    return render_template("notifications.html", notifications=rows)
+@app.route("/notifications")
+def notifications():
+    init_db()
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("login"))
+
+    rows, next_before = fetch_notifications(user["id"], request.args.get("before"))
+    mark_notifications_read(user["id"], rows)
+
+    return render_template("notifications.html", notifications=rows, next_before=next_before)
+
+@app.route("/api/notifications")
+def api_notifications():
+    init_db()
+    user = get_current_user()
+    if not user:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+
+    rows, next_before = fetch_notifications(user["id"], request.args.get("before"))
+    if request.args.get("mark_read") == "1":
+        mark_notifications_read(user["id"], rows)
+    return jsonify({"ok": True, "next_before": next_before, "notifications": [
+        {
+            "id": r["id"],
+            "type": r["type"],
+            "from_user_id": r["from_user_id"],
+            "from_name": r["from_name"],
+            "post_id": r["post_id"],
+            "actor_count": r["actor_count"],
+            "recent_actors": json.loads(r["recent_actors"] or "[]"),
+            "is_read": bool(r["is_read"]),
+            "created_at": r["created_at"],
+            "updated_at": r["updated_at"],
+        } for r in rows
+    ]})
+
+@app.route("/api/notifications/unread_count")
+def api_unread_count():
+    # polled by the badge in layout.html: session only, no init_db(), one row
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"ok": False, "error": "login needed"}), 401
+    try:
+        row = get_db().execute("SELECT unread FROM notification_counters WHERE user_id = ?", (uid,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    return jsonify({"ok": True, "unread": row["unread"] if row else 0})
 
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    # accepts both sharded "ab/cd/<name>" paths and legacy flat names
+    return send_from_directory(app.config["UPLOAD_FOLDER"], resolve_upload_name(filename))
 
 @app.route("/about")
 def about():
@@ -1679,9 +4023,9 @@ def edit_profile():
                 return redirect(url_for("edit_profile"))
             fname = secure_filename(file.filename)
             stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            avatar_fname = f"{stamp}_{fname}"
+            avatar_fname, avatar_path = new_upload_path(f"{stamp}_{fname}")
             try:
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], avatar_fname))
+                file.save(avatar_path)
             except Exception as e:
                 flash("Failed to save avatar.", "danger")
                 return redirect(url_for("edit_profile"))
@@ -1690,7 +4034,7 @@ def edit_profile():
             try:
                 old = user["avatar_filename"] if "avatar_filename" in user.keys() else None
                 if old:
-                    old_path = os.path.join(app.config["UPLOAD_FOLDER"], old)
+                    old_path = os.path.join(app.config["UPLOAD_FOLDER"], resolve_upload_name(old))
                     if os.path.exists(old_path):
                         os.remove(old_path)
             except Exception:
@@ -1707,6 +4051,7 @@ def edit_profile():
                 (new_display, new_kidsta, avatar_fname, user["id"])
             )
             db.commit()
+            invalidate_current_user(user["id"])
         except Exception as e:
             flash("Failed to update profile. Maybe KIDSTA ID already taken.", "danger")
             return redirect(url_for("edit_profile"))
@@ -1736,9 +4081,9 @@ def save_profile():
         if allowed_file(file.filename):
             fname = secure_filename(file.filename)
             stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            avatar_fname = f"{stamp}_{fname}"
+            avatar_fname, avatar_path = new_upload_path(f"{stamp}_{fname}")
             try:
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], avatar_fname))
+                file.save(avatar_path)
             except Exception:
                 pass
         else:
@@ -1749,6 +4094,7 @@ def save_profile():
     db.execute("UPDATE users SET display_name = ?, bio = ?, avatar_filename = ? WHERE id = ?",
                (display_name or user["display_name"], bio or user.get("bio"), avatar_fname, user["id"]))
     db.commit()
+    invalidate_current_user(user["id"])
 
     # Update session values too
     session["display_name"] = display_name or session.get("display_name")
@@ -1757,6 +4103,19 @@ def save_profile():
     flash("Profile updated.", "success")
     return redirect("/profile")
 
+# ---------- Background workers ----------
+# Nothing here runs at import: scripts, benchmarks and the REPL import app
+# too, and the janitor deletes files. The server entrypoints call this once
+# per process -- gunicorn from post_fork (gunicorn.conf.py), the dev server
+# from __main__ below.
+def start_background_workers():
+    removed = cleanup_stale_renders()
+    if removed:
+        print(f"RENDER_JANITOR removed={removed}")
+    start_background_gc()
+    start_background_suggestions()
+    start_background_media_meta()
+
 # ---------- Run ----------
 if __name__ == "__main__":
     with app.app_context():
@@ -1764,6 +4123,7 @@ if __name__ == "__main__":
     import os
 
 if __name__ == "__main__":
+    start_background_workers()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
 
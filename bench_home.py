@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Feed header-timing benchmark: when does the browser learn about the first
+screen's media on /home?
+
+For each request it records the time until the response headers arrive
+(carrying the Link: rel=preload list) and the time until each of those URLs
+first shows up in the streamed HTML, i.e. when a browser without the hints
+would discover it. The difference is how much earlier the image fetches can
+start.
+
+Usage:
+    python bench_home.py [--url http://127.0.0.1:5000] [--runs 20]
+                         [--user bench_home]
+
+Start the app yourself first on a scratch copy of kidsta.db; the first run
+creates the bench account through /login.
+"""
+import sys
+import time
+import statistics
+
+import requests
+
+PASSWORD = "bench-password-123"
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def parse_links(header):
+    urls = []
+    for part in (header or "").split(","):
+        part = part.strip()
+        if part.startswith("<") and ">" in part:
+            urls.append(part[1:part.index(">")])
+    return urls
+
+
+def one_run(session, url):
+    t0 = time.perf_counter()
+    r = session.get(url + "/home", stream=True, timeout=60,
+                    headers={"Accept-Encoding": "gzip", "Cache-Control": "no-cache"})
+    t_headers = time.perf_counter() - t0
+    hinted = [u for u in parse_links(r.headers.get("Link")) if not u.startswith("/static/")]
+
+    found = {}
+    seen = ""
+    t_first = None
+    for chunk in r.iter_content(chunk_size=None, decode_unicode=True):
+        if t_first is None:
+            t_first = time.perf_counter() - t0
+        seen += chunk
+        now = time.perf_counter() - t0
+        for u in hinted:
+            if u not in found and u in seen:
+                found[u] = now
+    t_total = time.perf_counter() - t0
+    return t_headers, t_first or t_total, t_total, hinted, found
+
+
+def main():
+    args = sys.argv[1:]
+    opts = {"--url": "http://127.0.0.1:5000", "--runs": "20", "--user": "bench_home"}
+    for key in opts:
+        if key in args:
+            opts[key] = args[args.index(key) + 1]
+    url = opts["--url"].rstrip("/")
+    runs = int(opts["--runs"])
+
+    session = requests.Session()
+    r = session.post(url + "/login", data={"username": opts["--user"], "password": PASSWORD, "age": "10"},
+                     allow_redirects=False, timeout=60)
+    if r.status_code != 302:
+        print(f"login failed: {r.status_code}")
+        return
+
+    headers, first, total, leads = [], [], [], []
+    hinted_count = 0
+    for _ in range(runs):
+        t_headers, t_first, t_total, hinted, found = one_run(session, url)
+        headers.append(t_headers)
+        first.append(t_first)
+        total.append(t_total)
+        hinted_count = len(hinted)
+        leads.extend(found[u] - t_headers for u in hinted if u in found)
+
+    ms = lambda v: f"{v * 1000:.1f} ms"
+    print(f"/home x{runs}: {hinted_count} media URL(s) hinted in Link")
+    print(f"headers (preload hints): p50 {ms(statistics.median(headers))}, p95 {ms(pct(headers, 95))}")
+    print(f"first body byte:         p50 {ms(statistics.median(first))}, p95 {ms(pct(first, 95))}")
+    print(f"full page:               p50 {ms(statistics.median(total))}, p95 {ms(pct(total, 95))}")
+    if leads:
+        print(f"hint lead over HTML discovery: p50 {ms(statistics.median(leads))}, max {ms(max(leads))}")
+
+
+if __name__ == "__main__":
+    main()
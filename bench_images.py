@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: legacy PNG image prep vs normalize_image().
+
+Usage:
+    python bench_images.py [corpus_dir] [--repeat N] [--format JPEG|WEBP]
+
+corpus_dir defaults to static/uploads. Every png/jpg/jpeg/webp in it is
+prepared both ways and we print per-image time and temp-file size.
+"""
+import os
+import sys
+import time
+import tempfile
+import statistics
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from image_prep import normalize_image
+
+EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def legacy_prepare(data, out_path, target_size=(720, 1280), fill_color=(255, 255, 255)):
+    # the old save_image_safely(): full decode, RGBA, lossless PNG
+    img = Image.open(BytesIO(data)).convert("RGBA")
+    w, h = img.size
+    if w < 50 or h < 50:
+        canvas = Image.new("RGBA", target_size, fill_color + (255,))
+        thumb = ImageOps.contain(img, target_size)
+        canvas.paste(thumb, ((target_size[0] - thumb.width) // 2, (target_size[1] - thumb.height) // 2), thumb)
+        canvas.convert("RGB").save(out_path, format="PNG")
+    else:
+        img.convert("RGB").save(out_path, format="PNG")
+
+
+def fast_prepare(data, out_path, fmt):
+    normalize_image(BytesIO(data), out_path, fmt=fmt)
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def main():
+    args = sys.argv[1:]
+    repeat = 3
+    fmt = "JPEG"
+    if "--repeat" in args:
+        i = args.index("--repeat")
+        repeat = int(args[i + 1])
+        del args[i:i + 2]
+    if "--format" in args:
+        i = args.index("--format")
+        fmt = args[i + 1].upper()
+        del args[i:i + 2]
+    corpus = args[0] if args else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "uploads")
+
+    files = sorted(f for f in os.listdir(corpus) if f.lower().endswith(EXTS))
+    if not files:
+        print("No images found in", corpus)
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix="kidsta_bench_")
+    legacy_out = os.path.join(tmpdir, "legacy.png")
+    fast_out = os.path.join(tmpdir, "fast." + ("webp" if fmt == "WEBP" else "jpg"))
+
+    rows = []
+    print(f"{'image':48} {'legacy ms':>10} {'fast ms':>9} {'legacy KB':>10} {'fast KB':>8}")
+    for name in files:
+        with open(os.path.join(corpus, name), "rb") as f:
+            data = f.read()
+        try:
+            t_old = timed(lambda: legacy_prepare(data, legacy_out), repeat)
+            t_new = timed(lambda: fast_prepare(data, fast_out, fmt), repeat)
+        except Exception as e:
+            print(f"{name[:48]:48} skipped: {e}")
+            continue
+        s_old = os.path.getsize(legacy_out)
+        s_new = os.path.getsize(fast_out)
+        rows.append((t_old, t_new, s_old, s_new))
+        print(f"{name[:48]:48} {t_old * 1000:10.1f} {t_new * 1000:9.1f} {s_old / 1024:10.1f} {s_new / 1024:8.1f}")
+
+    for p in (legacy_out, fast_out):
+        if os.path.exists(p):
+            os.remove(p)
+    os.rmdir(tmpdir)
+
+    if not rows:
+        return
+    t_old = statistics.median(r[0] for r in rows)
+    t_new = statistics.median(r[1] for r in rows)
+    s_old = sum(r[2] for r in rows)
+    s_new = sum(r[3] for r in rows)
+    print()
+    print(f"images: {len(rows)}  format: {fmt}  repeat: {repeat}")
+    print(f"median prep time: legacy {t_old * 1000:.1f} ms, fast {t_new * 1000:.1f} ms ({t_old / max(t_new, 1e-9):.1f}x)")
+    print(f"total temp size:  legacy {s_old / 1024:.0f} KB, fast {s_new / 1024:.0f} KB ({s_old / max(s_new, 1):.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
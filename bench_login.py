@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Login-storm benchmark: logins/sec and the latency of an unrelated route
+while many clients log in at once.
+
+Usage:
+    python bench_login.py [--url http://127.0.0.1:5000] [--clients 32]
+                          [--seconds 20] [--accounts 50] [--probe /about]
+
+Start the app yourself first (e.g. the Procfile's gunicorn line) on a
+scratch copy of kidsta.db: the first pass creates bench_<n> accounts.
+The probe route is sampled on its own during a quiet baseline and then
+during the storm; compare the p99s with and without KIDSTA_PASSWORD_WORKERS
+/ KIDSTA_PASSWORD_MAX_PENDING tuned.
+"""
+import sys
+import time
+import threading
+import statistics
+
+import requests
+
+PASSWORD = "bench-password-123"
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def login(url, username):
+    t0 = time.perf_counter()
+    r = requests.post(url + "/login", data={"username": username, "password": PASSWORD, "age": "10"},
+                      allow_redirects=False, timeout=60)
+    return r.status_code, time.perf_counter() - t0
+
+
+def probe_loop(url, path, stop, out):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        try:
+            requests.get(url + path, timeout=60)
+            out.append(time.perf_counter() - t0)
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+
+
+def sample_probe(url, path, seconds):
+    out = []
+    stop = threading.Event()
+    t = threading.Thread(target=probe_loop, args=(url, path, stop, out))
+    t.start()
+    time.sleep(seconds)
+    stop.set()
+    t.join()
+    return out
+
+
+def storm_client(url, accounts, idx, deadline, results):
+    n = idx
+    while time.time() < deadline:
+        try:
+            status, dt = login(url, f"bench_{n % accounts}")
+        except requests.RequestException:
+            status, dt = "error", 0.0
+        results.append((status, dt))
+        n += 1
+
+
+def main():
+    args = sys.argv[1:]
+    opts = {"--url": "http://127.0.0.1:5000", "--clients": "32", "--seconds": "20",
+            "--accounts": "50", "--probe": "/about"}
+    for key in opts:
+        if key in args:
+            opts[key] = args[args.index(key) + 1]
+    url = opts["--url"].rstrip("/")
+    clients = int(opts["--clients"])
+    seconds = float(opts["--seconds"])
+    accounts = int(opts["--accounts"])
+    probe = opts["--probe"]
+
+    print(f"Creating/logging in {accounts} bench accounts on {url} ...")
+    for i in range(accounts):
+        status, _ = login(url, f"bench_{i}")
+        if status not in (302, 503):
+            print(f"  bench_{i}: unexpected status {status}")
+
+    print(f"Baseline: sampling {probe} for 5s ...")
+    baseline = sample_probe(url, probe, 5)
+
+    print(f"Storm: {clients} clients logging in for {seconds:.0f}s while sampling {probe} ...")
+    results = []
+    during = []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe_loop, args=(url, probe, stop, during))
+    deadline = time.time() + seconds
+    workers = [threading.Thread(target=storm_client, args=(url, accounts, i, deadline, results))
+               for i in range(clients)]
+    t0 = time.time()
+    prober.start()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - t0
+    stop.set()
+    prober.join()
+
+    ok = [dt for status, dt in results if status == 302]
+    busy = sum(1 for status, _ in results if status == 503)
+    other = len(results) - len(ok) - busy
+
+    print()
+    print(f"logins: {len(ok)} ok, {busy} turned away (503), {other} other  in {elapsed:.1f}s")
+    print(f"throughput: {len(ok) / elapsed:.1f} logins/sec")
+    if ok:
+        print(f"login latency: p50 {statistics.median(ok) * 1000:.0f} ms, p99 {pct(ok, 99) * 1000:.0f} ms")
+    print(f"{probe} baseline: p50 {pct(baseline, 50) * 1000:.1f} ms, p99 {pct(baseline, 99) * 1000:.1f} ms  (n={len(baseline)})")
+    print(f"{probe} in storm: p50 {pct(during, 50) * 1000:.1f} ms, p99 {pct(during, 99) * 1000:.1f} ms  (n={len(during)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# gunicorn settings for the Procfile web process.
+
+def post_fork(server, worker):
+    # background work runs per worker, so it starts after the fork and never
+    # at import (see start_background_workers in app.py)
+    import app
+    app.start_background_workers()
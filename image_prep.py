@@ -0,0 +1,131 @@
+"""
+Image preparation for uploads and slideshow stills: reduced-size decode,
+EXIF rotation and a compact JPEG/WEBP write.
+
+Kept free of app imports and side effects so scripts (bench_images.py)
+can use it without starting the app's background threads.
+"""
+import os
+import shutil
+
+from PIL import Image, ImageOps
+
+# Output format for normalized stills. JPEG is the fastest to write; WEBP is
+# smaller but slower to encode. Both are read fine by ffmpeg.
+NORMALIZE_FORMAT = os.environ.get("KIDSTA_NORMALIZE_FORMAT", "JPEG").upper()
+NORMALIZE_QUALITY = int(os.environ.get("KIDSTA_NORMALIZE_QUALITY", "85"))
+
+# EXIF orientations that swap width and height
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def normalize_image(src, out_path, target_size=(720, 1280), fill_color=(255, 255, 255),
+                    fmt=None, quality=None):
+    """
+    Decode `src` (path or file-like) at reduced resolution, apply EXIF rotation,
+    shrink it to fit inside target_size and write a compact JPEG/WEBP to out_path.
+    - JPEGs are decoded with draft() so the DCT does most of the downscaling.
+    - Transparent images are flattened onto fill_color.
+    - Tiny images (< 50px) are centred on a full target_size canvas.
+    Returns out_path, or None if Pillow can't read the input.
+    """
+    fmt = (fmt or NORMALIZE_FORMAT).upper()
+    quality = quality or NORMALIZE_QUALITY
+    try:
+        with Image.open(src) as im:
+            box = target_size
+            try:
+                if im.getexif().get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:
+                    box = (target_size[1], target_size[0])
+            except Exception:
+                pass
+
+            if im.format == "JPEG":
+                # lets libjpeg decode at 1/2, 1/4 or 1/8 scale (never below box)
+                im.draft("RGB", box)
+
+            im = ImageOps.exif_transpose(im)
+            # thumbnail() uses reduce() first, then a resample for the remainder
+            im.thumbnail(target_size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                im = im.convert("RGBA")
+                flat = Image.new("RGB", im.size, fill_color)
+                flat.paste(im, (0, 0), im)
+                im = flat
+            elif im.mode != "RGB":
+                im = im.convert("RGB")
+
+            w, h = im.size
+            if w < 50 or h < 50:
+                canvas = Image.new("RGB", target_size, fill_color)
+                thumb = ImageOps.contain(im, target_size)
+                canvas.paste(thumb, ((target_size[0] - thumb.width) // 2,
+                                     (target_size[1] - thumb.height) // 2))
+                im = canvas
+
+            if fmt == "WEBP":
+                im.save(out_path, format="WEBP", quality=quality, method=0)
+            else:
+                im.save(out_path, format="JPEG", quality=quality)
+    except Exception as e:
+        print("normalize_image failed:", e)
+        return None
+
+    return out_path
+
+
+def ensure_min_image_size(path, min_w=720, min_h=1280, bg_color=(255,255,255)):
+    """
+    If the image at `path` is smaller than min_w/min_h, create a new image
+    min_w x min_h with bg_color and center the original image on it.
+    Overwrites the original file with a normalized RGB JPEG/WEBP.
+    """
+    try:
+        with Image.open(path) as im:
+            w, h = im.size
+            if w >= min_w and h >= min_h:
+                return path
+
+            if im.mode != "RGBA":
+                im = im.convert("RGBA")
+
+            bg = Image.new("RGB", (min_w, min_h), bg_color)
+            x = (min_w - w) // 2
+            y = (min_h - h) // 2
+            bg.paste(im, (x, y), im)
+
+        if NORMALIZE_FORMAT == "WEBP":
+            bg.save(path, format="WEBP", quality=NORMALIZE_QUALITY, method=0)
+        else:
+            bg.save(path, format="JPEG", quality=NORMALIZE_QUALITY)
+
+    except Exception as e:
+        print("ensure_min_image_size failed:", e)
+
+    return path
+
+
+def save_image_safely(file_storage, out_path, target_size=(720, 1280), fill_color=(255, 255, 255)):
+    """
+    Save an uploaded image (werkzeug FileStorage or file-like) to out_path.
+    - Normalizes it with normalize_image() (reduced decode, EXIF rotation, fast JPEG/WEBP).
+    - If Pillow can't read it, the raw bytes are written instead.
+    """
+    stream = getattr(file_storage, "stream", file_storage)
+
+    if normalize_image(stream, out_path, target_size=target_size, fill_color=fill_color) is None:
+        # if Pillow can't open, write raw bytes to disk
+        try:
+            stream.seek(0)
+        except Exception:
+            pass
+        with open(out_path, "wb") as f:
+            shutil.copyfileobj(stream, f)
+
+    # try to reset file_storage pointer for callers that expect it (best effort)
+    try:
+        stream.seek(0)
+    except Exception:
+        pass
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Move flat static/uploads/<name> files into hashed shards (ab/cd/<name>) and
+rewrite posts.media_filename, post_media.filename and users.avatar_filename.
+Only files those columns reference are moved; render and upload temps
+(which the app may still be writing) and anything unreferenced stay put,
+so it can run while the site takes traffic.
+
+Safe to stop and re-run: each batch moves files and commits the matching DB
+rewrite, and every run first repairs rows whose file was moved by an earlier
+run that died before its commit. Until a row is rewritten, /uploads/<name>
+still finds the file through resolve_upload_name().
+
+Usage:
+    python migrate_uploads.py [--batch 500] [--limit N] [--dry-run]
+"""
+import os
+import sys
+import sqlite3
+import hashlib
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB = os.path.join(BASE_DIR, "kidsta.db")
+UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
+
+# keep in sync with app.LEGACY_RENDER_TEMP_PREFIXES
+TEMP_PREFIXES = ("concat_", "tmp_img_", "tmp_upimg_", "tmp_upvid_", "photo_", "merged_", "tmp_reel_")
+
+# (table, column) pairs that hold upload names
+COLUMNS = [
+    ("posts", "media_filename"),
+    ("post_media", "filename"),
+    ("users", "avatar_filename"),
+]
+
+
+def shard_upload_name(filename):
+    # keep in sync with app.shard_upload_name (not imported, so this script
+    # runs without Flask and the rest of the app)
+    base = os.path.basename(filename)
+    h = hashlib.md5(base.encode("utf-8")).hexdigest()
+    return f"{h[0:2]}/{h[2:4]}/{base}"
+
+
+def rewrite_rows(cur, old, new):
+    n = 0
+    for table, col in COLUMNS:
+        cur.execute(f"UPDATE {table} SET {col} = ? WHERE {col} = ?", (new, old))
+        n += cur.rowcount
+    return n
+
+
+def referenced_flat_names(cur):
+    """Flat (unsharded) names the DB still points at."""
+    names = set()
+    for table, col in COLUMNS:
+        for (name,) in cur.execute(f"SELECT DISTINCT {col} FROM {table} WHERE {col} IS NOT NULL AND {col} NOT LIKE '%/%'"):
+            names.add(name)
+    return names
+
+
+def is_movable(name):
+    if name.startswith(".") or name.endswith(".part") or name.startswith(TEMP_PREFIXES):
+        return False
+    return os.path.isfile(os.path.join(UPLOAD_FOLDER, name))
+
+
+def repair_moved_rows(cur, dry_run):
+    """Rewrite flat names whose file already sits in its shard."""
+    fixed = 0
+    for table, col in COLUMNS:
+        rows = cur.execute(f"SELECT DISTINCT {col} FROM {table} WHERE {col} IS NOT NULL AND {col} NOT LIKE '%/%'").fetchall()
+        for (name,) in rows:
+            flat = os.path.join(UPLOAD_FOLDER, name)
+            sharded = shard_upload_name(name)
+            if not os.path.exists(flat) and os.path.exists(os.path.join(UPLOAD_FOLDER, sharded)):
+                if not dry_run:
+                    fixed += rewrite_rows(cur, name, sharded)
+                else:
+                    fixed += 1
+    return fixed
+
+
+def main():
+    args = sys.argv[1:]
+    batch = 500
+    limit = None
+    dry_run = "--dry-run" in args
+    if "--batch" in args:
+        batch = int(args[args.index("--batch") + 1])
+    if "--limit" in args:
+        limit = int(args[args.index("--limit") + 1])
+
+    if not os.path.exists(DB):
+        print("DB not found:", DB)
+        return
+    conn = sqlite3.connect(DB, timeout=30)
+    cur = conn.cursor()
+
+    fixed = repair_moved_rows(cur, dry_run)
+    conn.commit()
+    if fixed:
+        print("Repaired rows from an interrupted run:", fixed)
+
+    pending = sorted(name for name in referenced_flat_names(cur) if is_movable(name))
+    if limit is not None:
+        pending = pending[:limit]
+    print(f"Flat files to move: {len(pending)} (batch {batch}{', dry run' if dry_run else ''})")
+
+    moved = rows = 0
+    for start in range(0, len(pending), batch):
+        chunk = pending[start:start + batch]
+        for name in chunk:
+            sharded = shard_upload_name(name)
+            if dry_run:
+                print(f"  {name} -> {sharded}")
+                continue
+            dest = os.path.join(UPLOAD_FOLDER, sharded)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(os.path.join(UPLOAD_FOLDER, name), dest)
+            rows += rewrite_rows(cur, name, sharded)
+            moved += 1
+        conn.commit()
+        print(f"  batch {start // batch + 1}: {min(start + batch, len(pending))}/{len(pending)} files")
+
+    conn.close()
+    print(f"Done. Files moved: {moved}, rows rewritten: {rows}")
+
+
+if __name__ == "__main__":
+    main()
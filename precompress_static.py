@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Write .gz (and .br, when the brotli module is installed) next to every
+static text asset so the app can send them without compressing per request.
+
+Run at deploy time, before the workers start (see Procfile). Files whose
+compressed copy is already newer than the source are skipped, and copies
+that wouldn't save anything are removed. static/uploads and
+static/audio_library are user media and are left alone.
+
+Usage:
+    python precompress_static.py [--force] [--verbose]
+"""
+import os
+import sys
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+SKIP_DIRS = {"uploads", "audio_library"}
+EXTS = (".css", ".js", ".svg", ".html", ".txt", ".json", ".map")
+MIN_BYTES = 256
+
+
+def write_atomic(path, data):
+    # several deploy hooks / workers may race on the same file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def pack(src, suffix, compress, force, verbose):
+    out = src + suffix
+    if not force and os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(src):
+        return 0, 0
+    with open(src, "rb") as f:
+        data = f.read()
+    packed = compress(data)
+    if len(packed) >= len(data):
+        if os.path.exists(out):
+            os.remove(out)
+        return 0, 0
+    write_atomic(out, packed)
+    if verbose:
+        print(f"  {os.path.relpath(out, STATIC_DIR)}: {len(data)} -> {len(packed)} bytes")
+    return len(data), len(packed)
+
+
+def main():
+    args = sys.argv[1:]
+    force = "--force" in args
+    verbose = "--verbose" in args
+
+    coders = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        coders.append((".br", lambda d: brotli.compress(d, quality=11)))
+    else:
+        print("brotli not installed: writing .gz only")
+
+    files = raw = packed = 0
+    for dirpath, dirnames, filenames in os.walk(STATIC_DIR):
+        if dirpath == STATIC_DIR:
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for name in filenames:
+            if not name.endswith(EXTS):
+                continue
+            src = os.path.join(dirpath, name)
+            if os.path.getsize(src) < MIN_BYTES:
+                continue
+            for suffix, compress in coders:
+                before, after = pack(src, suffix, compress, force, verbose)
+                if before:
+                    files += 1
+                    raw += before
+                    packed += after
+
+    print(f"Precompressed {files} file(s): {raw} -> {packed} bytes")
+
+
+if __name__ == "__main__":
+    main()
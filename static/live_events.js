@@ -0,0 +1,53 @@
+// Live events from /events (SSE), falling back to /api/events/poll where
+// EventSource isn't available, where the caller asks for {stream: false}, or
+// when the server is out of stream slots (503). The poll loop long-polls
+// when the server has a free slot and otherwise sleeps for its `retry` hint.
+// onEvent gets each event's JSON payload.
+//   kidstaLive({posts: [1, 2, 3]}, function(ev){ ... });
+function kidstaLive(opts, onEvent){
+  opts = opts || {};
+  var query = (opts.posts && opts.posts.length) ? ('posts=' + opts.posts.join(',')) : '';
+  var after = '';
+  var stopped = false;
+  var es = null;
+
+  function deliver(ev){
+    try{ onEvent(ev); }catch(err){}
+  }
+
+  function poll(){
+    if(stopped) return;
+    var url = '/api/events/poll?' + query + (after !== '' ? '&after=' + after : '');
+    fetch(url, {credentials: 'same-origin'})
+      .then(function(r){ return r.ok ? r.json() : null; })
+      .then(function(d){
+        if(d && d.ok){
+          after = d.last;
+          d.events.forEach(deliver);
+          setTimeout(poll, (d.retry || 0) * 1000);
+        } else {
+          setTimeout(poll, 15000);
+        }
+      })
+      .catch(function(){ setTimeout(poll, 15000); });
+  }
+
+  if(window.EventSource && opts.stream !== false){
+    es = new EventSource('/events' + (query ? '?' + query : ''));
+    es.onmessage = function(e){
+      if(e.lastEventId) after = e.lastEventId;
+      try{ deliver(JSON.parse(e.data)); }catch(err){}
+    };
+    // network drops reconnect by themselves (retry: from the server, resuming
+    // from Last-Event-ID); a refused stream (503) closes it for good
+    es.onerror = function(){
+      if(es.readyState === EventSource.CLOSED && !stopped){
+        es = null;
+        poll();
+      }
+    };
+  } else {
+    poll();
+  }
+  return { close: function(){ stopped = true; if(es) es.close(); } };
+}